@@ -159,6 +159,10 @@ class _AgentTask(QtCore.QRunnable):
             except Exception as e:
                 self.set_status(self.agent.id, "error", str(e))
                 self.log(self.agent.id, f"error: {e}")
+            finally:
+                # Pooled clients are per loop and this loop ends with the task
+                from vex_native.http_pool import aclose_clients
+                await aclose_clients()
         try:
             asyncio.run(_run())
         except RuntimeError:
@@ -177,35 +181,37 @@ class _AgentTask(QtCore.QRunnable):
         event = payload.get("event")
         if event != "on_chat_turn_saved":
             return
-        msg = (payload.get("message") or {}).get("content") or ""
-        role = (payload.get("message") or {}).get("role") or "user"
-        if role != "user" and not save_assistant:
-            return
-        text = str(msg).strip()
-        if len(text) < min_chars:
-            self.log(agent.id, f"skip (too short): {len(text)} chars")
+        # Batch mode: payload["messages"] carries many pending messages scored in one pass
+        pending = payload.get("messages") or [payload.get("message") or {}]
+        texts: List[str] = []
+        for m in pending:
+            role = (m or {}).get("role") or "user"
+            if role != "user" and not save_assistant:
+                continue
+            text = str((m or {}).get("content") or "").strip()
+            if len(text) < min_chars:
+                self.log(agent.id, f"skip (too short): {len(text)} chars")
+                continue
+            texts.append(text)
+        if not texts:
             return
-        # Compute novelty vs existing memory in this collection
+        # Compute novelty vs existing memory in this collection, using the vectors the store
+        # already holds for its hits (no re-embedding)
         from vex_native.memory.embedder import get_embedder
-        from vex_native.memory.store import ChromaStore
+        from vex_native.memory.store import get_store
+        from vex_native.memory.novelty import novelty_batch
         emb = get_embedder()
-        qvec = await emb.embed_one(text)
-        store = ChromaStore()
-        hits = await store.query(collection=col, query_embedding=qvec, n_results=5)
-        sims: List[float] = []
-        # For a quick proxy, compute cosine by embedding the top hits again (small k)
-        for h in hits:
-            try:
-                vec2 = await emb.embed_one(h.get("text") or "")
-                # both normalized embeddings
-                sim = sum(a*b for a,b in zip(qvec, vec2))
-                sims.append(sim)
-            except Exception:
+        qvecs = [await emb.embed_one(texts[0])] if len(texts) == 1 else await emb.embed_batch(texts)
+        store = get_store()
+        hits = await store.query_batch(col, qvecs, n_results=5, include_distances=True, include_embeddings=True)
+        novelties = novelty_batch(qvecs, hits, dedupe=True)
+        keep = []
+        for text, qvec, novelty in zip(texts, qvecs, novelties):
+            if novelty < min_novelty:
+                self.log(agent.id, f"skip (novelty {novelty:.2f} < {min_novelty})")
                 continue
-        max_sim = max(sims) if sims else 0.0
-        novelty = 1.0 - max_sim
-        if novelty < min_novelty:
-            self.log(agent.id, f"skip (novelty {novelty:.2f} < {min_novelty})")
+            keep.append((text, qvec, novelty))
+        if not keep:
             return
         # Write file to memory root and upsert
         from vex_native.config import load_settings
@@ -216,17 +222,27 @@ class _AgentTask(QtCore.QRunnable):
         col_dir = memroot / col
         col_dir.mkdir(parents=True, exist_ok=True)
         ts = int(time.time())
-        head = " ".join(text.split()[:6])
-        slug = re.sub(r"[^a-zA-Z0-9_-]+", "_", head)[:40] or "mem"
-        p = col_dir / f"{ts}_{slug}.md"
-        p.write_text(text, encoding='utf-8')
-        meta = {"path": str(p)}
-        if tag_keywords:
-            tags = [kw for kw in tag_keywords if kw.lower() in text.lower()]
-            if tags:
-                meta["tags"] = tags
-        await store.upsert(collection=col, embeddings=[qvec], documents=[text], metadatas=[meta])
-        self.log(agent.id, f"saved to {col}: {p.name} (novelty {novelty:.2f})")
+        saved = []
+        metas: List[Dict[str, Any]] = []
+        for text, qvec, novelty in keep:
+            head = " ".join(text.split()[:6])
+            slug = re.sub(r"[^a-zA-Z0-9_-]+", "_", head)[:40] or "mem"
+            p = col_dir / f"{ts}_{slug}.md"
+            n = 1
+            while p.exists():
+                p = col_dir / f"{ts}_{slug}_{n}.md"
+                n += 1
+            p.write_text(text, encoding='utf-8')
+            meta = {"path": str(p)}
+            if tag_keywords:
+                tags = [kw for kw in tag_keywords if kw.lower() in text.lower()]
+                if tags:
+                    meta["tags"] = tags
+            metas.append(meta)
+            saved.append((p, novelty))
+        await store.upsert(collection=col, embeddings=[k[1] for k in keep], documents=[k[0] for k in keep], metadatas=metas)
+        for p, novelty in saved:
+            self.log(agent.id, f"saved to {col}: {p.name} (novelty {novelty:.2f})")
 
 
 agent_manager = AgentManager()
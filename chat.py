@@ -2,13 +2,125 @@ from __future__ import annotations
 
 import asyncio
 import json
-from typing import AsyncIterator, Dict, List, Optional, Callable
+import time
+from dataclasses import dataclass, asdict
+from json.decoder import scanstring
+from typing import Any, AsyncIterator, Dict, List, Optional, Callable
 
 import httpx
 
+from .http_pool import get_client
 
-async def stream_chat(server_url: str, messages: List[Dict], gen: Optional[Dict] = None, stop_flag: Optional[Callable[[], bool]] = None) -> AsyncIterator[str]:
-    """Stream tokens from an OpenAI-compatible /v1/chat/completions endpoint."""
+
+@dataclass
+class StreamStats:
+    """Counters for the streaming path (per-event parse cost, cancel latency)."""
+    streams: int = 0
+    events: int = 0
+    tokens: int = 0
+    bytes: int = 0
+    parse_ns: int = 0
+    full_parses: int = 0          # events that needed a full json.loads
+    cancels: int = 0
+    cancel_latency_ms_total: float = 0.0
+    last_cancel_latency_ms: float = 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        out = asdict(self)
+        out["parse_us_per_event"] = (self.parse_ns / self.events / 1000.0) if self.events else 0.0
+        out["avg_cancel_latency_ms"] = (self.cancel_latency_ms_total / self.cancels) if self.cancels else 0.0
+        return out
+
+
+STREAM_STATS = StreamStats()
+
+_DELTA = b'"delta"'
+_CONTENT = b'"content"'
+_WS = b" \t\r\n"
+
+
+def _delta_content(payload: bytes) -> Optional[str]:
+    """choices[0].delta.content from one chunk, decoding only that string.
+
+    Falls back to a full json.loads when the chunk is not shaped like a plain delta.
+    """
+    i = payload.find(_DELTA)
+    if i >= 0:
+        j = payload.find(_CONTENT, i)
+        if j >= 0:
+            k = j + len(_CONTENT)
+            n = len(payload)
+            while k < n and payload[k] in _WS:
+                k += 1
+            if k < n and payload[k] == 58:  # ':'
+                k += 1
+                while k < n and payload[k] in _WS:
+                    k += 1
+                if payload.startswith(b"null", k):
+                    return None
+                if k < n and payload[k] == 34:  # '"'
+                    try:
+                        text = payload.decode("utf-8")
+                        # byte offset -> str offset only differs with multibyte chars before k
+                        start = k + 1 if text.isascii() else len(payload[:k + 1].decode("utf-8"))
+                        return scanstring(text, start)[0]
+                    except Exception:
+                        pass
+    STREAM_STATS.full_parses += 1
+    try:
+        obj = json.loads(payload)
+    except Exception:
+        return None
+    choices = obj.get("choices", []) if isinstance(obj, dict) else []
+    if not choices:
+        return None
+    return (choices[0].get("delta") or {}).get("content")
+
+
+async def _iter_sse_data(r: httpx.Response) -> AsyncIterator[bytes]:
+    """Yield the payload of each `data:` line from the (decoded) response bytes."""
+    buf = b""
+    async for chunk in r.aiter_bytes():
+        STREAM_STATS.bytes += len(chunk)
+        buf = buf + chunk if buf else chunk
+        start = 0
+        while True:
+            nl = buf.find(b"\n", start)
+            if nl < 0:
+                break
+            line = buf[start:nl]
+            start = nl + 1
+            if line.startswith(b"data:"):
+                yield line[5:].strip()
+        buf = buf[start:]
+    if buf.startswith(b"data:"):
+        yield buf[5:].strip()
+
+
+async def _cancel_on_stop(r: httpx.Response, stop_event: Optional[asyncio.Event],
+                          stop_flag: Optional[Callable[[], bool]], fired: List[float]) -> None:
+    """One watcher per stream: close the upstream response as soon as a stop is requested.
+
+    Closing mid-body drops the connection, which is what makes llama-server release the slot.
+    """
+    if stop_flag is None and stop_event is not None:
+        await stop_event.wait()
+    else:
+        # Legacy callable: poll at a fixed low rate instead of per token
+        while not ((stop_flag and stop_flag()) or (stop_event is not None and stop_event.is_set())):
+            await asyncio.sleep(0.05)
+    fired.append(time.perf_counter())
+    await r.aclose()
+
+
+async def stream_chat(server_url: str, messages: List[Dict], gen: Optional[Dict] = None,
+                      stop_flag: Optional[Callable[[], bool]] = None,
+                      stop_event: Optional[asyncio.Event] = None) -> AsyncIterator[str]:
+    """Stream tokens from an OpenAI-compatible /v1/chat/completions endpoint.
+
+    Stop with `stop_event.set()` (or the legacy `stop_flag` callable), or by cancelling
+    the consuming task; either way the upstream response is closed immediately.
+    """
     body = {
         "model": "local",
         "messages": messages,
@@ -18,36 +130,41 @@ async def stream_chat(server_url: str, messages: List[Dict], gen: Optional[Dict]
         body.update({k: v for k, v in gen.items() if v is not None})
     url = server_url.rstrip("/") + "/v1/chat/completions"
     timeout = httpx.Timeout(connect=5.0, read=10.0, write=10.0, pool=5.0)
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        async with client.stream("POST", url, json=body) as r:
-            ait = r.aiter_lines()
-            while True:
-                if stop_flag and stop_flag():
-                    break
-                try:
-                    # allow responsiveness to stop_flag
-                    line = await asyncio.wait_for(ait.__anext__(), timeout=0.5)
-                except asyncio.TimeoutError:
-                    continue
-                except StopAsyncIteration:
+    client = get_client(url)
+    STREAM_STATS.streams += 1
+    async with client.stream("POST", url, json=body, timeout=timeout) as r:
+        if r.status_code >= 400:
+            await r.aread()
+            r.raise_for_status()
+        fired: List[float] = []
+        watcher = None
+        if stop_event is not None or stop_flag is not None:
+            if (stop_flag and stop_flag()) or (stop_event is not None and stop_event.is_set()):
+                return
+            watcher = asyncio.ensure_future(_cancel_on_stop(r, stop_event, stop_flag, fired))
+        try:
+            async for data in _iter_sse_data(r):
+                if data == b"[DONE]":
                     break
-                if not line:
-                    continue
-                if line.startswith("data: "):
-                    data = line[6:].strip()
-                    if data == "[DONE]":
-                        break
-                    try:
-                        obj = json.loads(data)
-                    except Exception:
-                        continue
-                    choices = obj.get("choices", [])
-                    if not choices:
-                        continue
-                    delta = choices[0].get("delta", {})
-                    content = delta.get("content")
-                    if content:
-                        yield content
+                t0 = time.perf_counter_ns()
+                content = _delta_content(data)
+                STREAM_STATS.parse_ns += time.perf_counter_ns() - t0
+                STREAM_STATS.events += 1
+                if content:
+                    STREAM_STATS.tokens += 1
+                    yield content
+        except Exception:
+            # Reads fail once the watcher has closed the response; that is the stop path
+            if not fired:
+                raise
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            if fired:
+                lat = (time.perf_counter() - fired[0]) * 1000.0
+                STREAM_STATS.cancels += 1
+                STREAM_STATS.cancel_latency_ms_total += lat
+                STREAM_STATS.last_cancel_latency_ms = lat
 
 
 async def once_chat(server_url: str, messages: List[Dict], gen: Optional[Dict] = None) -> str:
@@ -59,8 +176,7 @@ async def once_chat(server_url: str, messages: List[Dict], gen: Optional[Dict] =
     if gen:
         body.update({k: v for k, v in gen.items() if v is not None})
     url = server_url.rstrip("/") + "/v1/chat/completions"
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        r = await client.post(url, json=body)
-        r.raise_for_status()
-        obj = r.json()
-        return obj.get("choices", [{}])[0].get("message", {}).get("content", "")
+    r = await get_client(url).post(url, json=body, timeout=30.0)
+    r.raise_for_status()
+    obj = r.json()
+    return obj.get("choices", [{}])[0].get("message", {}).get("content", "")
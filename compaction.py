@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from .chat import once_chat
+from .sessions import add_summary, get_summary, messages_after
+
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation. Update the existing summary with the new turns. "
+    "Keep names, decisions, facts, open questions and user preferences; drop pleasantries. "
+    "Reply with the updated summary only."
+)
+
+# (messages, gen) -> reply; lets the summary go to the turn's provider
+Summarizer = Callable[[List[Dict[str, str]], Dict[str, Any]], Awaitable[str]]
+
+# Per-session lock and the number of callers holding or waiting on it; dropped at zero
+_LOCKS: Dict[str, List[Any]] = {}
+
+
+@asynccontextmanager
+async def _session_lock(session_id: str) -> AsyncIterator[None]:
+    entry = _LOCKS.setdefault(session_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            _LOCKS.pop(session_id, None)
+
+
+@dataclass
+class CompactionPolicy:
+    keep_recent: int = 12    # turns always sent verbatim
+    chunk: int = 8           # aged-out turns folded into the summary per update
+    max_tokens: int = 512
+
+    @classmethod
+    def from_meta(cls, meta: Optional[Dict[str, Any]]) -> Optional["CompactionPolicy"]:
+        cfg = (meta or {}).get("compaction")
+        if not cfg:
+            return None
+        cfg = cfg if isinstance(cfg, dict) else {}
+        return cls(
+            keep_recent=int(cfg.get("keep_recent", cls.keep_recent)),
+            chunk=max(1, int(cfg.get("chunk", cls.chunk))),
+            max_tokens=int(cfg.get("max_tokens", cls.max_tokens)),
+        )
+
+
+def apply_summary(messages: List[Dict[str, str]], summary: Dict[str, Any], stored: List[Dict[str, Any]],
+                  regenerate: bool = False) -> List[Dict[str, str]]:
+    """Prompt history for a summarised session.
+
+    Returns the caller's system messages, the summary, the stored turns after
+    summary["end_id"] (from messages_after) and then the caller's new user turn.
+    The stored rows, not the caller's transcript, decide what the summary has
+    already covered. The transcript need not match the DB 1:1: regenerate stores
+    a user turn again, and empty replies are not stored.
+    """
+    if not (summary or {}).get("summary") or not summary.get("end_id"):
+        return messages
+    lead = [m for m in messages if m.get("role") == "system"]
+    turn = messages[-1] if messages and messages[-1].get("role") == "user" else None
+    rows: List[Dict[str, str]] = []
+    for r in stored:
+        if not r.get("content"):
+            continue
+        if rows and r["role"] == "user" and rows[-1] == {"role": "user", "content": r["content"]}:
+            continue  # regenerate stored the same user turn again
+        rows.append({"role": r["role"], "content": r["content"]})
+    if turn is not None:
+        # The new turn may already be stored; on regenerate, so may replies to it that the UI discarded
+        users = [i for i, r in enumerate(rows) if r["role"] == "user"]
+        if users and rows[users[-1]]["content"] == turn.get("content") and (regenerate or users[-1] == len(rows) - 1):
+            rows = rows[:users[-1]]
+        rows.append(turn)
+    note = {"role": "system", "content": "## Conversation summary (earlier turns):\n" + summary["summary"]}
+    return lead + [note] + rows
+
+
+def _transcript(rows: List[Dict[str, Any]]) -> str:
+    return "\n\n".join(f"{(r.get('role') or '').title()}: {r.get('content') or ''}" for r in rows)
+
+
+async def compact_session(server_url: str, session_id: str, policy: CompactionPolicy,
+                          summarize: Optional[Summarizer] = None) -> Optional[Dict[str, Any]]:
+    """Fold turns that aged out of the recent window into the session summary.
+
+    Incremental: only turns after the previous summary's end_id are sent, along with
+    that summary. The summary is written by `summarize`, else by the local server at
+    `server_url`. Returns the new summary row, or None when nothing was due.
+    """
+    if summarize is None:
+        summarize = lambda msgs, gen: once_chat(server_url, msgs, gen=gen)  # noqa: E731
+    async with _session_lock(session_id):
+        prev = await asyncio.to_thread(get_summary, session_id)
+        rows = await asyncio.to_thread(messages_after, session_id, int(prev.get("end_id") or 0))
+        aged = rows[:max(0, len(rows) - policy.keep_recent)]
+        if len(aged) < policy.chunk:
+            return None
+        prompt = ("Existing summary:\n" + (prev.get("summary") or "(none)") +
+                  "\n\nNew turns:\n" + _transcript(aged))
+        summary = await summarize([
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": prompt},
+        ], {"temperature": 0.2, "max_tokens": policy.max_tokens})
+        summary = (summary or "").strip()
+        if not summary:
+            return None
+        row = {
+            "start_id": int(prev.get("start_id") or aged[0]["id"]),
+            "end_id": int(aged[-1]["id"]),
+            "n_messages": int(prev.get("n_messages") or 0) + len(aged),
+            "summary": summary,
+        }
+        await asyncio.wrap_future(add_summary(session_id, row["start_id"], row["end_id"], row["n_messages"], summary))
+        return row
@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+
+from .http_pool import get_client
+from .response_cache import local_model_id
+from .sessions import get_token_counts, put_token_counts
+
+
+# Chat-template tokens per message (role markers, separators); llama.cpp templates add ~3-5
+MESSAGE_OVERHEAD = 4
+
+# /tokenize calls in flight per count; llama-server shares its HTTP threads with generation
+TOKENIZE_CONCURRENCY = 4
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def estimate_tokens(text: str) -> int:
+    # Deliberately pessimistic (~3 chars/token) so estimates never overflow the real window
+    return (len(text) + 2) // 3 if text else 0
+
+
+async def _tokenize(client: httpx.AsyncClient, server_url: str, text: str) -> int:
+    r = await client.post(server_url.rstrip("/") + "/tokenize", json={"content": text}, timeout=5.0)
+    r.raise_for_status()
+    return len(r.json().get("tokens", []))
+
+
+async def count_tokens(texts: Sequence[str], server_url: Optional[str] = None, model_key: str = "") -> Tuple[List[int], str]:
+    """Token counts for `texts`, via llama-server /tokenize with counts cached in the sessions DB.
+
+    Returns (counts, method) where method is "tokenize" or "estimate" (no server, or
+    the server could not tokenize).
+    """
+    hashes = [content_hash(t) for t in texts]
+    key = model_key
+    if not key and server_url:
+        # Counts belong to the tokenizer, not the port: a restart may load another model on the same URL
+        ident = await local_model_id(server_url, ttl=5.0)
+        key = ident if ident != server_url else ""
+    try:
+        cached = await asyncio.to_thread(get_token_counts, key, sorted(set(hashes))) if key else {}
+    except Exception:
+        cached = {}
+    todo = {h: t for h, t in zip(hashes, texts) if h not in cached}
+    method = "tokenize"
+    if todo and server_url:
+        try:
+            client = get_client(server_url)
+            sem = asyncio.Semaphore(TOKENIZE_CONCURRENCY)
+
+            async def _bounded(text: str) -> int:
+                async with sem:
+                    return await _tokenize(client, server_url, text)
+
+            counts = await asyncio.gather(*(_bounded(t) for t in todo.values()))
+            fresh = dict(zip(todo.keys(), counts))
+            cached.update(fresh)
+            try:
+                if key:
+                    await asyncio.to_thread(put_token_counts, key, fresh)
+            except Exception:
+                pass
+        except Exception:
+            method = "estimate"
+    elif todo:
+        method = "estimate"
+    return [cached[h] if h in cached else estimate_tokens(t) for h, t in zip(hashes, texts)], method
+
+
+@dataclass
+class ContextBudget:
+    n_ctx: int = 4096
+    reserve: int = 512       # room left for the reply (max_tokens)
+    min_recent: int = 2      # history turns kept ahead of recalls
+    margin: int = 32         # slack for template differences between servers
+    model: str = ""          # token-count cache key; defaults to the served model's id
+
+    @property
+    def available(self) -> int:
+        return max(0, self.n_ctx - self.reserve - self.margin)
+
+    @classmethod
+    def from_meta(cls, meta: Optional[Dict[str, Any]], gen: Optional[Dict[str, Any]] = None) -> Optional["ContextBudget"]:
+        """Budget from meta["context"], else from the configured Settings.n_ctx.
+
+        Returns None when context management is off: meta["context"] is False,
+        or neither meta nor settings give a window. The settings window is the
+        local server's, so it is not applied to OpenRouter turns.
+        """
+        ctx = (meta or {}).get("context")
+        if ctx is False:
+            return None
+        ctx = ctx if isinstance(ctx, dict) else {}
+        local = (meta or {}).get("source", "local") != "openrouter"
+        n_ctx = ctx.get("n_ctx") or (_configured_n_ctx() if local else None)
+        if not n_ctx:
+            return None
+        reserve = ctx.get("reserve") or (gen or {}).get("max_tokens") or cls.reserve
+        return cls(
+            n_ctx=int(n_ctx),
+            reserve=int(reserve),
+            min_recent=int(ctx.get("min_recent", cls.min_recent)),
+            margin=int(ctx.get("margin", cls.margin)),
+            model=str(ctx.get("model") or ""),
+        )
+
+
+_N_CTX_CACHE: Tuple[float, Optional[int]] = (-1.0, None)
+
+
+def _configured_n_ctx() -> Optional[int]:
+    """Settings.n_ctx, re-read only when config.yaml changes."""
+    global _N_CTX_CACHE
+    from .config import CONFIG_PATH, load_settings  # lazy: config pulls in yaml
+    try:
+        mtime = CONFIG_PATH.stat().st_mtime if CONFIG_PATH.exists() else 0.0
+        if mtime != _N_CTX_CACHE[0]:
+            _N_CTX_CACHE = (mtime, int(load_settings().n_ctx or 0) or None)
+        return _N_CTX_CACHE[1]
+    except Exception:
+        return None
+
+
+def plan_context(budget: ContextBudget, system_tokens: int, recall_tokens: int, message_tokens: List[int]) -> Dict[str, Any]:
+    """Decide what fits, by priority.
+
+    1. system prompt without recalls and the latest message (always kept)
+    2. the `min_recent` turns before it
+    3. recalls
+    4. older history, newest first, stopping at the first turn that does not fit
+    Returns the trim decision; `keep_from` indexes the first message kept.
+    """
+    n = len(message_tokens)
+    avail = budget.available
+    used = system_tokens + (message_tokens[-1] if n else 0)
+    keep_from = max(0, n - 1)
+    recent_floor = max(0, n - 1 - budget.min_recent)
+    while keep_from > recent_floor and used + message_tokens[keep_from - 1] <= avail:
+        keep_from -= 1
+        used += message_tokens[keep_from]
+    keep_recalls = recall_tokens > 0 and used + recall_tokens <= avail
+    if keep_recalls:
+        used += recall_tokens
+    if keep_from == recent_floor:
+        while keep_from > 0 and used + message_tokens[keep_from - 1] <= avail:
+            keep_from -= 1
+            used += message_tokens[keep_from]
+    return {
+        **asdict(budget),
+        "available": avail,
+        "used": used,
+        "keep_from": keep_from,
+        "dropped_messages": keep_from,
+        "recalls_dropped": recall_tokens > 0 and not keep_recalls,
+        "overflow": used > avail,
+    }
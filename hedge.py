@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from dataclasses import dataclass, asdict
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+
+@dataclass
+class HedgeStats:
+    streams: int = 0
+    hedged: int = 0            # backup request was started
+    primary_wins: int = 0
+    backup_wins: int = 0
+    ttft_ms_total: float = 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        out = asdict(self)
+        out["avg_ttft_ms"] = (self.ttft_ms_total / self.streams) if self.streams else 0.0
+        return out
+
+
+HEDGE_STATS = HedgeStats()
+
+_END = object()
+
+
+async def _first(ait: AsyncIterator[str]) -> Any:
+    try:
+        return await ait.__anext__()
+    except StopAsyncIteration:
+        return _END
+
+
+async def _discard(task: "asyncio.Future[Any]", ait: AsyncIterator[str]) -> None:
+    """Cancel a losing request and close its stream so the upstream connection is dropped."""
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+    try:
+        await ait.aclose()  # type: ignore[attr-defined]
+    except BaseException:
+        pass
+
+
+async def hedged_stream(primary: Callable[[], AsyncIterator[str]], backup: Callable[[], AsyncIterator[str]],
+                        ttft_deadline: float) -> AsyncIterator[str]:
+    """Start `primary`; if no first token within `ttft_deadline` seconds also start `backup`.
+
+    Whichever stream yields first wins and the loser is cancelled. If one side fails
+    before producing anything, the other side is still awaited.
+    """
+    t0 = time.perf_counter()
+    HEDGE_STATS.streams += 1
+    p_it = primary()
+    p_task = asyncio.ensure_future(_first(p_it))
+    try:
+        done, _ = await asyncio.wait({p_task}, timeout=ttft_deadline)
+    except BaseException:
+        await _discard(p_task, p_it)
+        raise
+    if done and not p_task.exception():
+        winner, first = p_it, p_task.result()
+        HEDGE_STATS.primary_wins += 1
+    else:
+        HEDGE_STATS.hedged += 1
+        b_it = backup()
+        b_task = asyncio.ensure_future(_first(b_it))
+        racers = {p_task: p_it, b_task: b_it}
+        pending = {t for t in racers if not t.done()}
+        winner = None
+        first = None
+        err: Optional[BaseException] = None
+        try:
+            while winner is None:
+                finished = [t for t in racers if t.done()]
+                ok = [t for t in finished if not t.cancelled() and t.exception() is None]
+                if ok:
+                    # Prefer the primary if both are already done
+                    t = p_task if p_task in ok else ok[0]
+                    winner, first = racers[t], t.result()
+                    break
+                for t in finished:
+                    err = err or t.exception()
+                if not pending:
+                    raise err or RuntimeError("hedged request failed")
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for t, it in racers.items():
+                if it is not winner:
+                    await _discard(t, it)
+        if winner is p_it:
+            HEDGE_STATS.primary_wins += 1
+        else:
+            HEDGE_STATS.backup_wins += 1
+    HEDGE_STATS.ttft_ms_total += (time.perf_counter() - t0) * 1000.0
+    if first is _END:
+        return
+    try:
+        yield first
+        async for tok in winner:
+            yield tok
+    finally:
+        await winner.aclose()  # type: ignore[attr-defined]
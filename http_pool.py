@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import asyncio
+import weakref
+from dataclasses import dataclass, replace
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+
+@dataclass
+class PoolConfig:
+    max_connections: int = 32
+    max_keepalive_connections: int = 16
+    keepalive_expiry: float = 60.0
+    http2: bool = False           # opt-in; needs the `h2` package, falls back to HTTP/1.1 without it
+
+
+_CONFIG = PoolConfig()
+# Clients are bound to the loop they were first used on; agent threads run their own loops
+_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, httpx.AsyncClient]]" = weakref.WeakKeyDictionary()
+
+
+def configure(**kwargs) -> PoolConfig:
+    """Update pool settings; applies to clients created afterwards."""
+    global _CONFIG
+    _CONFIG = replace(_CONFIG, **kwargs)
+    return _CONFIG
+
+
+def _origin(url: str) -> str:
+    u = urlsplit(url)
+    return f"{u.scheme}://{u.netloc}".lower()
+
+
+def _h2_available() -> bool:
+    try:
+        import h2  # type: ignore  # noqa: F401
+        return True
+    except Exception:
+        return False
+
+
+def get_client(url: str, http2: Optional[bool] = None) -> httpx.AsyncClient:
+    """Shared keep-alive client for the origin of `url` on the running loop.
+
+    Pass timeouts per request; the client itself carries only pool settings.
+    Short-lived loops (agent threads) must await aclose_clients() before they end,
+    or the client's sockets stay open.
+    """
+    loop = asyncio.get_running_loop()
+    per_loop = _CLIENTS.setdefault(loop, {})
+    want_h2 = _CONFIG.http2 if http2 is None else http2
+    key = _origin(url) + ("|h2" if want_h2 else "")
+    client = per_loop.get(key)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=_CONFIG.max_connections,
+                max_keepalive_connections=_CONFIG.max_keepalive_connections,
+                keepalive_expiry=_CONFIG.keepalive_expiry,
+            ),
+            http2=bool(want_h2) and _h2_available(),
+        )
+        per_loop[key] = client
+    return client
+
+
+async def aclose_clients() -> None:
+    """Close every client owned by the running loop (call on shutdown)."""
+    per_loop = _CLIENTS.pop(asyncio.get_running_loop(), {})
+    for client in per_loop.values():
+        try:
+            await client.aclose()
+        except Exception:
+            pass
@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ..config import CONFIG_DIR
+
+
+EMBED_CACHE_PATH = CONFIG_DIR / "embeddings.db"
+
+_FORMATS = {"float16": "<f2", "float32": "<f4"}
+
+
+def text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache: in-memory LRU in front of a SQLite table.
+
+    Rows are keyed by (model name, text hash) and vectors are packed little-endian
+    float16 (default) or float32. The memory tier holds the same packed numpy arrays.
+    Every vector handed out, whether cached or fresh (see quantize), has been through
+    the storage dtype, so a text embeds identically whatever the cache state.
+    """
+
+    def __init__(self, path: Path = EMBED_CACHE_PATH, dtype: str = "float16", max_items: int = 4096):
+        if dtype not in _FORMATS:
+            raise ValueError(f"unsupported dtype: {dtype}")
+        self.path = Path(path)
+        self.dtype = dtype
+        self.max_items = max(0, int(max_items))
+        self._mem: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._con = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT,
+                hash TEXT,
+                dtype TEXT,
+                dim INTEGER,
+                vec BLOB,
+                PRIMARY KEY (model, hash)
+            )
+            """
+        )
+        self._con.commit()
+
+    # --- encoding ---
+    def _array(self, vec: Sequence[float]) -> np.ndarray:
+        return np.asarray(vec, dtype=_FORMATS[self.dtype])
+
+    @staticmethod
+    def _unpack(blob: bytes, dtype: str, dim: int) -> np.ndarray:
+        return np.frombuffer(blob, dtype=_FORMATS[dtype], count=dim)
+
+    @staticmethod
+    def _vector(arr: np.ndarray) -> List[float]:
+        return arr.astype(np.float32).tolist()
+
+    def quantize(self, vecs: Sequence[Sequence[float]]) -> List[List[float]]:
+        """Round fresh vectors to the storage precision, so misses match later hits."""
+        return [self._vector(self._array(v)) for v in vecs]
+
+    def _remember(self, key: Tuple[str, str], vec: np.ndarray) -> None:
+        if not self.max_items:
+            return
+        self._mem[key] = vec
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    # --- lookup ---
+    def get_memory(self, model: str, text: str) -> Optional[List[float]]:
+        """Memory tier only; safe to call on the event loop."""
+        key = (model, text_hash(text))
+        with self._lock:
+            vec = self._mem.get(key)
+            if vec is None:
+                return None
+            self._mem.move_to_end(key)
+            self.hits += 1
+        return self._vector(vec)
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Both tiers; misses are counted here, so callers should encode whatever comes back None."""
+        keys = [(model, text_hash(t)) for t in texts]
+        out: List[Optional[List[float]]] = [None] * len(texts)
+        pending: Dict[str, List[int]] = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                vec = self._mem.get(key)
+                if vec is not None:
+                    self._mem.move_to_end(key)
+                    self.hits += 1
+                    out[i] = self._vector(vec)
+                else:
+                    pending.setdefault(key[1], []).append(i)
+            if pending:
+                hashes = list(pending)
+                for start in range(0, len(hashes), 500):
+                    chunk = hashes[start:start + 500]
+                    rows = self._con.execute(
+                        f"SELECT hash, dtype, dim, vec FROM embeddings WHERE model=? AND hash IN ({','.join('?' * len(chunk))})",
+                        (model, *chunk),
+                    ).fetchall()
+                    for h, dtype, dim, blob in rows:
+                        arr = self._unpack(blob, dtype, dim)
+                        self._remember((model, h), arr)
+                        vec = self._vector(arr)
+                        for i in pending.pop(h):
+                            out[i] = vec
+                            self.hits += 1
+                            self.disk_hits += 1
+                self.misses += sum(len(v) for v in pending.values())
+        return out
+
+    def put_many(self, model: str, texts: Sequence[str], vecs: Sequence[Sequence[float]]) -> None:
+        rows = []
+        with self._lock:
+            for t, v in zip(texts, vecs):
+                h = text_hash(t)
+                arr = self._array(v)
+                self._remember((model, h), arr)
+                rows.append((model, h, self.dtype, len(arr), arr.tobytes()))
+            if rows:
+                self._con.executemany("INSERT OR REPLACE INTO embeddings(model, hash, dtype, dim, vec) VALUES(?,?,?,?,?)", rows)
+                self._con.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "memory_items": len(self._mem),
+        }
+
+
+_CACHE: Optional[EmbeddingCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """Shared cache, or None if the cache DB cannot be opened (embedding still works uncached)."""
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                try:
+                    _CACHE = EmbeddingCache()
+                except Exception:
+                    return None
+    return _CACHE
@@ -1,44 +1,188 @@
 from __future__ import annotations
 
 import asyncio
-from typing import List
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
 
-_MODEL = None
+from .cache import EmbeddingCache, get_embedding_cache
 
+DEFAULT_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+DEFAULT_MAX_BATCH = 32
+DEFAULT_MAX_WAIT_MS = 5.0
 
-def _load_model(name: str = "sentence-transformers/all-MiniLM-L6-v2"):
-    global _MODEL
-    if _MODEL is None:
-        # Lazy import to avoid hard dependency if not used yet
-        try:
-            from sentence_transformers import SentenceTransformer  # type: ignore
-        except Exception as e:
-            raise RuntimeError("Memory embedding backend unavailable: sentence-transformers not installed") from e
-        # Prefer CUDA when available
+_MODELS: Dict[str, Any] = {}
+_EMBEDDERS: Dict[str, "Embedder"] = {}
+_LOCK = threading.Lock()
+
+
+def _load_model(name: str = DEFAULT_MODEL):
+    model = _MODELS.get(name)
+    if model is not None:
+        return model
+    with _LOCK:
+        model = _MODELS.get(name)
+        if model is None:
+            # Lazy import to avoid hard dependency if not used yet
+            try:
+                from sentence_transformers import SentenceTransformer  # type: ignore
+            except Exception as e:
+                raise RuntimeError("Memory embedding backend unavailable: sentence-transformers not installed") from e
+            # Prefer CUDA when available
+            try:
+                import torch  # type: ignore
+                device = "cuda" if torch.cuda.is_available() else "cpu"
+            except Exception:
+                device = "cpu"
+            model = SentenceTransformer(name, device=device)
+            _MODELS[name] = model
+        return model
+
+
+class _EmbedBatcher:
+    """Coalesces single-text encode requests into one model.encode call.
+
+    Runs on its own daemon thread and hands out concurrent futures, so callers on
+    any event loop (orchestrator, agent QRunnables) share the same batches.
+    """
+
+    def __init__(self, model, max_batch: int = DEFAULT_MAX_BATCH, max_wait_ms: float = DEFAULT_MAX_WAIT_MS,
+                 model_name: str = DEFAULT_MODEL, cache: Optional[EmbeddingCache] = None):
+        self.model = model
+        self.model_name = model_name
+        self.cache = cache
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait_ms = max(0.0, float(max_wait_ms))
+        self._q: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.last_batch_size = 0
+
+    def submit(self, text: str) -> Future:
+        fut: Future = Future()
+        self._ensure_thread()
+        self._q.put((text, fut))
+        return fut
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self._q.qsize(),
+            "last_batch_size": self.last_batch_size,
+            "avg_batch_size": (self.items / self.batches) if self.batches else 0.0,
+            "batches": self.batches,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait_ms,
+        }
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+                self._thread.start()
+
+    def _collect(self) -> List[Tuple[str, Future]]:
+        batch = [self._q.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._q.get(timeout=remaining) if remaining > 0 else self._q.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = [(t, f) for t, f in self._collect() if f.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                vecs = _encode_cached(self.model, self.model_name, self.cache, [t for t, _ in batch], self.max_batch)
+            except Exception as e:
+                for _, f in batch:
+                    f.set_exception(e)
+                continue
+            for (_, f), vec in zip(batch, vecs):
+                f.set_result(vec)
+            self.batches += 1
+            self.items += len(batch)
+            self.last_batch_size = len(batch)
+
+
+def _encode_cached(model, model_name: str, cache: Optional[EmbeddingCache], texts: List[str], batch_size: int) -> List[List[float]]:
+    """Encode `texts` (blocking), serving what it can from the cache and storing the rest."""
+    vecs: List[Optional[List[float]]] = [None] * len(texts)
+    if cache:
         try:
-            import torch  # type: ignore
-            device = "cuda" if torch.cuda.is_available() else "cpu"
+            vecs = cache.get_many(model_name, texts)
         except Exception:
-            device = "cpu"
-        _MODEL = SentenceTransformer(name, device=device)
-    return _MODEL
+            pass
+    missing: Dict[str, List[int]] = {}
+    for i, v in enumerate(vecs):
+        if v is None:
+            missing.setdefault(texts[i], []).append(i)
+    if missing:
+        # Length bucketing: sorted input lets encode() pad each mini-batch to similar lengths
+        todo = sorted(missing, key=len)
+        fresh = model.encode(todo, batch_size=batch_size, normalize_embeddings=True).tolist()
+        if cache:
+            fresh = cache.quantize(fresh)
+        for t, v in zip(todo, fresh):
+            for i in missing[t]:
+                vecs[i] = v
+        if cache:
+            try:
+                cache.put_many(model_name, todo, fresh)
+            except Exception:
+                pass
+    return vecs  # type: ignore[return-value]
 
 
 class Embedder:
-    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
+    def __init__(self, model_name: str = DEFAULT_MODEL, max_batch: int = DEFAULT_MAX_BATCH, max_wait_ms: float = DEFAULT_MAX_WAIT_MS,
+                 cache: Optional[EmbeddingCache] = None):
         self.model_name = model_name
         self.model = _load_model(model_name)
+        self.cache = cache
+        self.batcher = _EmbedBatcher(self.model, max_batch=max_batch, max_wait_ms=max_wait_ms, model_name=model_name, cache=cache)
+
+    def configure_batching(self, max_batch: Optional[int] = None, max_wait_ms: Optional[float] = None) -> None:
+        if max_batch is not None:
+            self.batcher.max_batch = max(1, int(max_batch))
+        if max_wait_ms is not None:
+            self.batcher.max_wait_ms = max(0.0, float(max_wait_ms))
+
+    def stats(self) -> Dict[str, Any]:
+        out = self.batcher.stats()
+        if self.cache:
+            out["cache"] = self.cache.stats()
+        return out
 
     async def embed_one(self, text: str) -> List[float]:
-        loop = asyncio.get_event_loop()
-        vec = await loop.run_in_executor(None, lambda: self.model.encode(text, normalize_embeddings=True).tolist())
-        return vec
+        if self.cache:
+            vec = self.cache.get_memory(self.model_name, text)
+            if vec is not None:
+                return vec
+        return await asyncio.wrap_future(self.batcher.submit(text))
 
     async def embed_batch(self, texts: List[str]) -> List[List[float]]:
         loop = asyncio.get_event_loop()
-        vecs = await loop.run_in_executor(None, lambda: self.model.encode(texts, normalize_embeddings=True).tolist())
+        vecs = await loop.run_in_executor(None, lambda: _encode_cached(self.model, self.model_name, self.cache, list(texts), self.batcher.max_batch))
         return vecs
 
 
-def get_embedder(model_name: str = "sentence-transformers/all-MiniLM-L6-v2") -> Embedder:
-    return Embedder(model_name)
+def get_embedder(model_name: str = DEFAULT_MODEL, max_batch: Optional[int] = None, max_wait_ms: Optional[float] = None) -> Embedder:
+    """Process-wide Embedder per model name; batching knobs apply to the shared instance."""
+    emb = _EMBEDDERS.get(model_name)
+    if emb is None:
+        # _load_model serialises the expensive part; setdefault keeps the first instance
+        emb = _EMBEDDERS.setdefault(model_name, Embedder(model_name, cache=get_embedding_cache()))
+    if max_batch is not None or max_wait_ms is not None:
+        emb.configure_batching(max_batch=max_batch, max_wait_ms=max_wait_ms)
+    return emb
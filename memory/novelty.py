@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+
+def similarity_from_distance(distance: float, space: str = "l2") -> float:
+    """Cosine similarity of unit vectors from a Chroma distance.
+
+    Chroma's default space is squared L2, where |a-b|^2 = 2 - 2cos for normalized vectors.
+    """
+    if space == "l2":
+        return 1.0 - distance / 2.0
+    return 1.0 - distance  # "cosine" and "ip" both report 1 - similarity
+
+
+def max_similarities(query_vecs: Sequence[Sequence[float]], hit_vecs: Sequence[Sequence[float]]) -> np.ndarray:
+    """Row-wise max cosine of each query against all hits (inputs are normalized embeddings)."""
+    q = np.asarray(query_vecs, dtype=np.float32)
+    if q.ndim == 1:
+        q = q[None, :]
+    if len(hit_vecs) == 0:
+        return np.zeros(q.shape[0], dtype=np.float32)
+    h = np.asarray(hit_vecs, dtype=np.float32)
+    return (q @ h.T).max(axis=1)
+
+
+def hits_similarity(query_vec: Sequence[float], hits: List[Dict], space: str = "l2") -> float:
+    """Max similarity of one query to its store hits, preferring stored vectors over distances."""
+    vecs = [h["embedding"] for h in hits if h.get("embedding") is not None]
+    if vecs:
+        return float(max_similarities([query_vec], vecs)[0])
+    dists = [h["distance"] for h in hits if h.get("distance") is not None]
+    if dists:
+        return max(similarity_from_distance(d, space) for d in dists)
+    return 0.0
+
+
+def novelty_batch(query_vecs: Sequence[Sequence[float]], hits_per_query: List[List[Dict]], dedupe: bool = False) -> List[float]:
+    """Novelty (1 - max similarity) for many pending vectors against a collection.
+
+    The union of all returned hit vectors is scored in one matrix multiply. Every
+    query's own nearest neighbour is in that union, so the row max is the same as
+    scoring each query against its own hits. With `dedupe`, earlier queries in the
+    batch also count as neighbours, so of several near-identical pending messages
+    only the first scores as novel.
+    """
+    if not len(query_vecs):
+        return []
+    q = np.asarray(query_vecs, dtype=np.float32)
+    union = [h["embedding"] for hits in hits_per_query for h in hits if h.get("embedding") is not None]
+    if union:
+        sims = max_similarities(q, union)
+    else:
+        sims = np.asarray([hits_similarity(qv, hits) for qv, hits in zip(q, hits_per_query)], dtype=np.float32)
+    if dedupe and len(q) > 1:
+        intra = q @ q.T
+        for i in range(1, len(q)):
+            sims[i] = max(sims[i], float(intra[i, :i].max()))
+    return [float(1.0 - s) for s in sims]
@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class RecallCache:
+    """LRU + TTL cache of vector-store hits keyed by (collection, query hash, k).
+
+    Each entry remembers what the miss cost (embed + query), so hits can report
+    the latency they saved. A per-collection generation, bumped on invalidate,
+    lets a query that raced an upsert skip storing its now-stale result.
+    """
+
+    def __init__(self, max_items: int = 512, ttl_s: float = 300.0):
+        self.max_items = max(1, int(max_items))
+        self.ttl_s = float(ttl_s)
+        self._items: "OrderedDict[Tuple[str, str, int], Tuple[float, float, List[Dict]]]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.saved_ms = 0.0
+
+    def get(self, collection: str, qhash: str, k: int) -> Optional[List[Dict]]:
+        key = (collection, qhash, k)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or time.monotonic() - item[0] > self.ttl_s:
+                if item is not None:
+                    del self._items[key]
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            self.saved_ms += item[1]
+            return item[2]
+
+    def generation(self, collection: str) -> int:
+        """Capture before querying; pass to put() so results from before an invalidate are dropped."""
+        with self._lock:
+            return self._generations.get(collection, 0)
+
+    def put(self, collection: str, qhash: str, k: int, hits: List[Dict], cost_ms: float = 0.0,
+            generation: Optional[int] = None) -> None:
+        with self._lock:
+            if generation is not None and generation != self._generations.get(collection, 0):
+                return
+            self._items[(collection, qhash, k)] = (time.monotonic(), cost_ms, hits)
+            self._items.move_to_end((collection, qhash, k))
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def invalidate(self, collection: str) -> None:
+        with self._lock:
+            self._generations[collection] = self._generations.get(collection, 0) + 1
+            stale = [key for key in self._items if key[0] == collection]
+            for key in stale:
+                del self._items[key]
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "saved_ms": round(self.saved_ms, 1),
+            "invalidations": self.invalidations,
+            "items": len(self._items),
+        }
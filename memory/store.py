@@ -2,10 +2,12 @@ from __future__ import annotations
 
 import asyncio
 import os
+import threading
 import uuid
-from typing import Dict, List
+from typing import Any, Dict, List
 
 from ..config import CONFIG_DIR
+from .recall_cache import RecallCache
 
 
 class ChromaStore:
@@ -18,13 +20,58 @@ class ChromaStore:
 
         persist_path = CONFIG_DIR / persist_subdir
         os.makedirs(persist_path, exist_ok=True)
-        self.client = chromadb.PersistentClient(path=str(persist_path), settings=Settings(anonymized_telemetry=False))
+        self.persist_path = str(persist_path)
+        self.client = chromadb.PersistentClient(path=self.persist_path, settings=Settings(anonymized_telemetry=False))
+        # Collection handles are cheap to keep and expensive to look up per query
+        self._collections: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        # Recall hits per (collection, query hash, k); dropped for a collection on upsert
+        self.recall_cache = RecallCache()
 
     def _get_collection(self, name: str):
+        col = self._collections.get(name)
+        if col is not None:
+            return col
+        with self._lock:
+            col = self._collections.get(name)
+            if col is None:
+                col = self.client.get_or_create_collection(name)
+                self._collections[name] = col
+            return col
+
+    def _forget_collection(self, name: str) -> None:
+        with self._lock:
+            self._collections.pop(name, None)
+
+    def _query_sync(self, collection: str, query_embeddings: List[List[float]], n_results: int,
+                    include_distances: bool = False, include_embeddings: bool = False) -> List[List[Dict]]:
+        include = ["documents", "metadatas"]
+        if include_distances:
+            include.append("distances")
+        if include_embeddings:
+            include.append("embeddings")
         try:
-            return self.client.get_collection(name)
+            res = self._get_collection(collection).query(query_embeddings=query_embeddings, n_results=n_results, include=include)
         except Exception:
-            return self.client.create_collection(name)
+            # Handle may be stale (collection dropped/recreated elsewhere); retry once with a fresh one
+            self._forget_collection(collection)
+            res = self._get_collection(collection).query(query_embeddings=query_embeddings, n_results=n_results, include=include)
+        out: List[List[Dict]] = []
+        for qi in range(len(query_embeddings)):
+            docs = _row(res, "documents", qi)
+            metas = _row(res, "metadatas", qi)
+            dists = _row(res, "distances", qi) if include_distances else None
+            embs = _row(res, "embeddings", qi) if include_embeddings else None
+            hits = []
+            for j, d in enumerate(docs):
+                h = {"text": d, "meta": (metas[j] if j < len(metas) else None) or {}}
+                if dists is not None and j < len(dists):
+                    h["distance"] = float(dists[j])
+                if embs is not None and j < len(embs):
+                    h["embedding"] = [float(x) for x in embs[j]]
+                hits.append(h)
+            out.append(hits)
+        return out
 
     async def upsert(self, collection: str, embeddings: List[List[float]], documents: List[str], metadatas: List[Dict]):
         col = self._get_collection(collection)
@@ -39,18 +86,30 @@ class ChromaStore:
                 mm["ts"] = ts
             safe_metas.append(mm)
         loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, lambda: col.add(embeddings=embeddings, documents=documents, metadatas=safe_metas, ids=ids))
+        try:
+            await loop.run_in_executor(None, lambda: col.add(embeddings=embeddings, documents=documents, metadatas=safe_metas, ids=ids))
+        finally:
+            self.recall_cache.invalidate(collection)
+
+    async def query(self, collection: str, query_embedding: List[float], n_results: int = 3,
+                    include_distances: bool = False, include_embeddings: bool = False):
+        """Top hits as {"text", "meta"} dicts, plus "distance"/"embedding" when requested."""
+        loop = asyncio.get_event_loop()
+        res = await loop.run_in_executor(None, lambda: self._query_sync(collection, [query_embedding], n_results, include_distances, include_embeddings))
+        return res[0]
 
-    async def query(self, collection: str, query_embedding: List[float], n_results: int = 3):
-        col = self._get_collection(collection)
+    async def query_batch(self, collection: str, query_embeddings: List[List[float]], n_results: int = 3,
+                          include_distances: bool = False, include_embeddings: bool = False) -> List[List[Dict]]:
+        """One collection, many query vectors, one round trip; returns hits per query."""
+        if not query_embeddings:
+            return []
         loop = asyncio.get_event_loop()
-        res = await loop.run_in_executor(None, lambda: col.query(query_embeddings=[query_embedding], n_results=n_results))
-        out = []
-        docs = res.get("documents", [[]])[0]
-        metas = res.get("metadatas", [[]])[0]
-        for d, m in zip(docs, metas):
-            out.append({"text": d, "meta": m or {}})
-        return out
+        return await loop.run_in_executor(None, lambda: self._query_sync(collection, query_embeddings, n_results, include_distances, include_embeddings))
+
+    async def query_many(self, collections: List[str], query_embedding: List[float], n_results: int = 3) -> Dict[str, List[Dict]]:
+        """Query several collections with one embedding, concurrently (latency is the slowest query, not the sum)."""
+        hits = await asyncio.gather(*(self.query(c, query_embedding, n_results) for c in collections))
+        return dict(zip(collections, hits))
 
     def list_collections(self):
         cols = []
@@ -61,3 +120,28 @@ class ChromaStore:
                 count = None
             cols.append({"name": c.name, "count": count})
         return cols
+
+
+def _row(res: Dict[str, Any], key: str, qi: int) -> list:
+    rows = res.get(key)
+    if rows is None or len(rows) <= qi or rows[qi] is None:
+        return []
+    return rows[qi]
+
+
+_STORES: Dict[str, ChromaStore] = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_store(persist_subdir: str = ".chroma") -> ChromaStore:
+    """Process-wide ChromaStore per persist path (one PersistentClient each)."""
+    key = str((CONFIG_DIR / persist_subdir).resolve())
+    store = _STORES.get(key)
+    if store is not None:
+        return store
+    with _STORES_LOCK:
+        store = _STORES.get(key)
+        if store is None:
+            store = ChromaStore(persist_subdir)
+            _STORES[key] = store
+        return store
@@ -1,25 +1,126 @@
 from __future__ import annotations
 
 import asyncio
+import logging
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, AsyncIterator, Dict, List, Optional, Callable
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Callable, Set, Tuple
 
 from .chat import stream_chat, once_chat
 from .providers.openrouter import stream_openrouter, once_openrouter
 from .agents.manager import agent_manager
 from .sessions import add_message, add_params, upsert_session
+from .context import ContextBudget, MESSAGE_OVERHEAD, count_tokens, plan_context
+from .compaction import CompactionPolicy, Summarizer, apply_summary, compact_session
+from .sessions import get_summary, messages_after
+from .streaming import CoalesceConfig, coalesce
+from .router import Backend, LoadAwareRouter, call_with_failover, stream_with_failover
+from .hedge import hedged_stream
+from .http_pool import get_client
+from .response_cache import cache_key, get_response_cache, is_deterministic, local_model_id
 
 # Memory imports are optional but expected to be installed for core usage
 try:
     from .memory.embedder import get_embedder
-    from .memory.store import ChromaStore
+    from .memory.store import get_store
+    from .memory.cache import text_hash
 except Exception:
     get_embedder = None  # type: ignore
-    ChromaStore = None  # type: ignore
+    get_store = None  # type: ignore
 
 
+_log = logging.getLogger(__name__)
+
 DEFAULT_PROMPT_PATH = Path(__file__).resolve().parents[0] / "models" / "presets" / "default_system_prompt.txt"
 
+# Strong refs to fire-and-forget work (persistence, agent events) so it is not GC'd mid-flight
+_BACKGROUND: Set[asyncio.Task] = set()
+
+# Last recalls per session so a regenerate can skip retrieval entirely
+_LAST_RECALLS: "OrderedDict[str, Dict[str, List[Dict]]]" = OrderedDict()
+_LAST_RECALLS_MAX = 256
+
+# Latest persistence task per session, awaited before compaction rebuilds history from the DB
+_LAST_PERSIST: Dict[str, asyncio.Task] = {}
+
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.get_running_loop().create_task(coro)
+    _BACKGROUND.add(task)
+    task.add_done_callback(_BACKGROUND.discard)
+    return task
+
+
+async def _after(prev: Optional[asyncio.Task], fn: Callable, *args) -> None:
+    """Run blocking `fn` in a worker thread once `prev` has finished (keeps DB writes ordered)."""
+    if prev is not None:
+        try:
+            await prev
+        except Exception:
+            pass
+    try:
+        res = await asyncio.to_thread(fn, *args)
+        if isinstance(res, Future):
+            await asyncio.wrap_future(res)  # sessions writes resolve once committed
+    except Exception:
+        _log.exception("background write %s failed", getattr(fn, "__name__", fn))
+
+
+def _summarizer(server_url: str, meta: Optional[Dict[str, Any]]) -> Optional[Summarizer]:
+    """Send compaction summaries to the turn's provider; None when there is no one to ask."""
+    if ((meta or {}).get("source") or "local") == "openrouter":
+        orc = (meta or {}).get("openrouter") or {}
+        api_key, model = orc.get("api_key", ""), orc.get("model", "openrouter/auto")
+        return lambda msgs, gen: once_openrouter(api_key, model, msgs, gen=gen)
+    if not server_url:
+        return None
+    return lambda msgs, gen: once_chat(server_url, msgs, gen=gen)
+
+
+async def _compact_after(prev: Optional[asyncio.Task], server_url: str, session_id: str, policy: CompactionPolicy,
+                         meta: Optional[Dict[str, Any]]) -> None:
+    """Fold aged-out turns into the rolling summary once this turn's rows are stored."""
+    summarize = _summarizer(server_url, meta)
+    if summarize is None:
+        return
+    if prev is not None:
+        try:
+            await prev
+        except Exception:
+            pass
+    try:
+        await compact_session(server_url, session_id, policy, summarize)
+    except Exception:
+        pass
+
+
+def _track_persist(session_id: str, task: asyncio.Task) -> asyncio.Task:
+    _LAST_PERSIST[session_id] = task
+    task.add_done_callback(lambda t: _LAST_PERSIST.pop(session_id, None) if _LAST_PERSIST.get(session_id) is t else None)
+    return task
+
+
+async def _summarized(session_id: str, messages: List[Dict[str, str]], policy: Optional[CompactionPolicy],
+                      meta: Optional[Dict[str, Any]] = None) -> List[Dict[str, str]]:
+    if policy is None:
+        return messages
+    # The previous turn's rows must be stored before the history is rebuilt from the DB
+    pending = _LAST_PERSIST.get(session_id)
+    if pending is not None and pending.get_loop() is asyncio.get_running_loop():
+        await asyncio.wait({pending}, timeout=5.0)
+    try:
+        summary = await asyncio.to_thread(get_summary, session_id)
+        if not summary.get("summary"):
+            return messages
+        stored = await asyncio.to_thread(messages_after, session_id, int(summary.get("end_id") or 0))
+    except Exception:
+        return messages
+    return apply_summary(messages, summary, stored, regenerate=bool((meta or {}).get("regenerate")))
+
 
 def detect_domains(messages: List[Dict[str, str]]) -> List[str]:
     text_blob = " ".join([m.get("content", "") for m in messages[-3:]]).lower()
@@ -35,7 +136,7 @@ def detect_domains(messages: List[Dict[str, str]]) -> List[str]:
     return domains
 
 
-async def _synthesize_persona_prompt(domains: List[str], recalls: Dict[str, List[Dict]], meta: Dict[str, Any]) -> str:
+def _static_prompt_lines(meta: Optional[Dict[str, Any]]) -> List[str]:
     try:
         base = DEFAULT_PROMPT_PATH.read_text(encoding="utf-8").strip()
     except Exception:
@@ -45,35 +146,104 @@ async def _synthesize_persona_prompt(domains: List[str], recalls: Dict[str, List
     user_prof = (meta or {}).get("user_profile")
     if isinstance(user_prof, str) and user_prof.strip():
         lines += ["", "## User Profile:", user_prof.strip()]
-    lines += ["", "## Context Recalls:"]
+    return lines
+
+
+def static_system_messages(meta: Optional[Dict[str, Any]] = None) -> List[Dict[str, str]]:
+    """The system layers shared by every turn (default prompt, user profile, persona).
+
+    This is the prefix a prefix_stable turn starts with, so it is what to send as
+    warm-up after a server (re)start, e.g.
+    ``await sup.start_and_wait_ready(warmup_messages=static_system_messages(meta))``.
+    """
+    stable = {**(meta or {}), "prompt_layout": "prefix_stable"}
+    return _build_final_messages([], stable, "\n".join(_static_prompt_lines(stable)))
+
+
+async def _synthesize_persona_prompt(domains: List[str], recalls: Dict[str, List[Dict]], meta: Dict[str, Any]) -> str:
+    lines = _static_prompt_lines(meta)
+    if _prefix_stable(meta):
+        # Recalls go on the latest user turn instead (see _with_volatile)
+        return "\n".join(lines)
+    lines += ["", _volatile_context(recalls)]
+    return "\n".join(lines)
+
+
+def _prefix_stable(meta: Optional[Dict[str, Any]]) -> bool:
+    return (meta or {}).get("prompt_layout") == "prefix_stable"
+
+
+def _volatile_context(recalls: Dict[str, List[Dict]]) -> str:
+    """Per-turn prompt content: the recalls.
+
+    meta itself is not shown to the model: it carries settings (context, hedge,
+    response_cache, slots) and the OpenRouter key, none of which the model needs.
+    """
+    lines = ["## Context Recalls:"]
     for d, hits in recalls.items():
         if not hits:
             continue
         lines.append(f"- [{d}]")
         for h in hits[:3]:
             lines.append(f"  • {h.get('text', '')[:300]}")
-    lines.append("")
-    if meta:
-        lines.append(f"## Meta: {meta}")
-    return "\n".join(lines)
+    return "\n".join(lines) + "\n"
 
 
-async def _recall(domains: List[str], query: str, k: int = 3) -> Dict[str, List[Dict]]:
+def _slot_params(session_id: str, meta: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """llama.cpp prompt-cache hints: reuse the KV prefix and pin a session to one slot."""
+    out: Dict[str, Any] = {"cache_prompt": True}
+    slot = (meta or {}).get("slot_id")
+    n_slots = int((meta or {}).get("n_slots") or 0)
+    if slot is None and n_slots > 1:
+        slot = zlib.crc32(session_id.encode("utf-8")) % n_slots
+    if slot is not None:
+        out["id_slot"] = int(slot)
+    return out
+
+
+async def _recall(domains: List[str], query: str, k: int = 3, qvec: Optional[List[float]] = None) -> Dict[str, List[Dict]]:
     if not query:
         return {d: [] for d in domains}
-    if get_embedder is None or ChromaStore is None:
+    if get_embedder is None or get_store is None:
         return {d: [] for d in domains}
-    emb = get_embedder()
-    qvec = await emb.embed_one(query)
-    store = ChromaStore()
+    store = get_store()
+    qhash = text_hash(query)
     out: Dict[str, List[Dict]] = {}
+    missing: List[str] = []
     for d in domains:
-        hits = await store.query(collection=d, query_embedding=qvec, n_results=k)
-        out[d] = hits
-    return out
+        hits = store.recall_cache.get(d, qhash, k)
+        if hits is None:
+            missing.append(d)
+        else:
+            out[d] = hits
+    if missing:
+        gens = {d: store.recall_cache.generation(d) for d in missing}
+        t0 = time.perf_counter()
+        if qvec is None:
+            qvec = await get_embedder().embed_one(query)
+        # All domains in one executor hop against the long-lived store
+        fresh = await store.query_many(missing, query_embedding=qvec, n_results=k)
+        cost_ms = (time.perf_counter() - t0) * 1000.0 / len(missing)
+        for d, hits in fresh.items():
+            store.recall_cache.put(d, qhash, k, hits, cost_ms=cost_ms, generation=gens[d])
+        out.update(fresh)
+    return {d: out.get(d, []) for d in domains}
+
 
+async def _session_recall(session_id: str, domains: List[str], query: str, meta: Optional[Dict[str, Any]], k: int = 3,
+                          qvec: Optional[List[float]] = None) -> Dict[str, List[Dict]]:
+    recalls = _LAST_RECALLS.get(session_id) if (meta or {}).get("regenerate") else None
+    if recalls is None or list(recalls) != domains:
+        recalls = await _recall(domains, query=query, k=k, qvec=qvec)
+    _LAST_RECALLS[session_id] = recalls
+    _LAST_RECALLS.move_to_end(session_id)
+    while len(_LAST_RECALLS) > _LAST_RECALLS_MAX:
+        _LAST_RECALLS.popitem(last=False)
+    return recalls
 
-def _build_final_messages(messages: List[Dict[str, str]], meta: Optional[Dict[str, Any]], base_prompt: str) -> List[Dict[str, str]]:
+
+def _build_final_messages(messages: List[Dict[str, str]], meta: Optional[Dict[str, Any]], base_prompt: str,
+                          volatile: Optional[str] = None) -> List[Dict[str, str]]:
     ui_opts = (meta or {}).get("ui_options") if meta else None
     final_system: Optional[str] = None
     if ui_opts and ui_opts.get("override_system") and ui_opts.get("system_prompt"):
@@ -103,11 +273,27 @@ def _build_final_messages(messages: List[Dict[str, str]], meta: Optional[Dict[st
                 layered = (persona_text_val + "\n\n" + base_prompt).strip()
         if use_persona:
             final_system = (user_sys + "\n\n" + layered).strip() if user_sys else layered
+            if volatile:
+                messages = _with_volatile(messages, volatile)
         else:
             final_system = user_sys.strip() if user_sys else None
     return ([{"role": "system", "content": final_system}] if final_system else []) + messages
 
 
+def _with_volatile(messages: List[Dict[str, str]], volatile: str) -> List[Dict[str, str]]:
+    """prefix_stable: carry the per-turn context on the last user turn.
+
+    The system prompt and all earlier history stay byte-identical across turns,
+    so llama.cpp reuses their KV cache. Only the new turn is evaluated. The
+    context is prefixed to the user message rather than sent as a mid-history
+    system message, which several chat templates reject.
+    """
+    if messages and messages[-1].get("role") == "user":
+        last = messages[-1]
+        return messages[:-1] + [{**last, "content": volatile + "\n\n## User Message:\n" + (last.get("content") or "")}]
+    return messages + [{"role": "system", "content": volatile}]
+
+
 def _map_gen_params(gen: Optional[Dict[str, Any]]) -> Dict[str, Any]:
     if not gen:
         return {}
@@ -124,46 +310,184 @@ def _map_gen_params(gen: Optional[Dict[str, Any]]) -> Dict[str, Any]:
     return out
 
 
+async def _assemble(messages: List[Dict[str, str]], domains: List[str], recalls: Dict[str, List[Dict]],
+                    meta: Optional[Dict[str, Any]]) -> List[Dict[str, str]]:
+    base_prompt = await _synthesize_persona_prompt(domains=domains, recalls=recalls, meta=meta or {})
+    volatile = _volatile_context(recalls) if _prefix_stable(meta) else None
+    return _build_final_messages(messages, meta, base_prompt, volatile=volatile)
+
+
+async def _fit_to_budget(server_url: Optional[str], messages: List[Dict[str, str]], domains: List[str],
+                         recalls: Dict[str, List[Dict]], meta: Optional[Dict[str, Any]],
+                         budget: ContextBudget) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+    no_recalls: Dict[str, List[Dict]] = {d: [] for d in recalls}
+    # Fixed prompt parts with and without recalls (prefix_stable puts the volatile block in its own entry here)
+    with_sys = await _assemble([], domains, recalls, meta)
+    bare_sys = await _assemble([], domains, no_recalls, meta)
+    texts = ["\n\n".join(m["content"] for m in with_sys), "\n\n".join(m["content"] for m in bare_sys)]
+    texts += [m.get("content") or "" for m in messages]
+    counts, method = await count_tokens(texts, server_url=server_url, model_key=budget.model)
+    sys_tokens = counts[1] + MESSAGE_OVERHEAD * len(bare_sys)
+    recall_tokens = max(0, counts[0] - counts[1])
+    plan = plan_context(budget, sys_tokens, recall_tokens, [c + MESSAGE_OVERHEAD for c in counts[2:]])
+    plan["counted_via"] = method
+    kept = messages[plan["keep_from"]:]
+    final = await _assemble(kept, domains, no_recalls if plan["recalls_dropped"] else recalls, meta)
+    return final, plan
+
+
+async def _prepare(server_url: Optional[str], messages: List[Dict[str, str]], session_id: str,
+                   meta: Optional[Dict[str, Any]], gen: Dict[str, Any],
+                   qvec: Optional[List[float]] = None) -> Tuple[List[str], List[Dict[str, str]], Optional[Dict[str, Any]]]:
+    """Domains, final messages and (when a context budget applies) the trim decision for one turn."""
+    domains = detect_domains(messages)
+    query = messages[-1]["content"] if messages else ""
+    recalls = await _session_recall(session_id, domains, query, meta, k=3, qvec=qvec)
+    budget = ContextBudget.from_meta(meta, gen)
+    if budget is None:
+        return domains, await _assemble(messages, domains, recalls, meta), None
+    final_messages, plan = await _fit_to_budget(server_url, messages, domains, recalls, meta, budget)
+    return domains, final_messages, plan
+
+
+def _persist_turn_start(session_id: str, messages: List[Dict[str, str]], meta: Optional[Dict[str, Any]],
+                        domains: List[str], final_messages: List[Dict[str, str]],
+                        context_plan: Optional[Dict[str, Any]] = None) -> None:
+    # Runs in a worker thread; sessions.* queue these writes for the store's writer thread,
+    # and waiting on their futures here surfaces a failed commit without holding up the stream
+    title_guess = None
+    for m in messages:
+        if m.get("role") == "user" and m.get("content"):
+            title_guess = (m.get("content").strip() or "")[0:48]
+            break
+    session = upsert_session(session_id, title=title_guess or session_id)
+    user = None
+    utext = ""
+    if messages and messages[-1].get("role") == "user":
+        utext = messages[-1].get("content", "")
+        user = add_message(session_id, "user", utext, meta or {})
+    params = add_params(session_id, {
+        "domains": domains,
+        "system_prompt": final_messages[0]["content"] if final_messages and final_messages[0].get("role") == "system" else None,
+        "ui": (meta or {}).get("ui_options") if meta else None,
+        "gen": (meta or {}).get("gen") if meta else None,
+        "context": context_plan,
+    })
+    if user is not None:
+        user.result()
+        try:
+            agent_manager.emit_event("on_chat_turn_saved", {"session_id": session_id, "message": {"role": "user", "content": utext}})
+        except Exception:
+            pass
+    session.result()
+    params.result()
+
+
+def _persist_once(session_id: str, messages: List[Dict[str, str]], meta: Optional[Dict[str, Any]],
+                  domains: List[str], out: str) -> None:
+    futs = [
+        upsert_session(session_id),
+        add_message(session_id, "user", messages[-1].get("content", "") if messages else "", meta or {}),
+        add_message(session_id, "assistant", out, {"route": {"mode": "llama_server", "domains": domains}}),
+    ]
+    for fut in futs:
+        fut.result()
+
+
+def _hedge_backup(hedge: Dict[str, Any], router: Optional[LoadAwareRouter], final_messages: List[Dict[str, str]],
+                  gen: Dict[str, Any], should_stop: Optional[Callable[[], bool]],
+                  stop_flag: Optional[Callable[[], bool]], stop_event: Optional[asyncio.Event]) -> Optional[Callable[[], AsyncIterator[str]]]:
+    """Backup stream factory for hedging: explicit URL, a saved connection profile, or another routed backend."""
+    url = hedge.get("url")
+    name = hedge.get("profile")
+    if not url and name:
+        from .config import load_settings  # lazy: only hedged turns read settings
+        prof = (load_settings().connection_profiles or {}).get(name)
+        if not isinstance(prof, dict):
+            return None
+        if (prof.get("chat_source") or "local") == "openrouter":
+            return lambda: stream_openrouter(prof.get("openrouter_api_key", ""), prof.get("openrouter_model", "openrouter/auto"),
+                                             final_messages, gen=gen, providers=prof.get("openrouter_providers") or None,
+                                             stop_flag=should_stop)
+        url = prof.get("server_url") or f"http://{prof.get('server_host', '127.0.0.1')}:{prof.get('server_port', 8080)}"
+    if url:
+        return lambda: stream_chat(url, final_messages, gen=gen, stop_flag=stop_flag, stop_event=stop_event)
+    if router is not None and len(router.backends) > 1:
+        # No affinity: the primary is outstanding, so least-loaded picks a different backend
+        return lambda: stream_with_failover(router, None, int(gen.get("max_tokens") or 0),
+                                            lambda u: stream_chat(u, final_messages, gen=gen, stop_flag=stop_flag, stop_event=stop_event))
+    return None
+
+
+async def _cache_model_id(source: str, meta: Optional[Dict[str, Any]], server_url: str,
+                          router: Optional[LoadAwareRouter]) -> Optional[str]:
+    """Model identity for response-cache keys, or None when it is not known which model will answer."""
+    if source == "openrouter":
+        return "openrouter:" + str(((meta or {}).get("openrouter") or {}).get("model", "openrouter/auto"))
+    if router is None:
+        return await local_model_id(server_url)
+    # Any routed backend may answer (failover, or both sides of a swap): cache only if they all run the same model
+    now = time.monotonic()
+    urls = [b.url for b in router.backends.values() if b.available(now)]
+    ids = set(await asyncio.gather(*(local_model_id(u) for u in urls)))
+    return ids.pop() if len(ids) == 1 else None
+
+
+def _base_url(server_url: str, router: Optional[LoadAwareRouter]) -> str:
+    # Side calls (/tokenize, summaries) go to a live routed backend when there is a router:
+    # after a swap the explicit URL may be a stopped server, and the first backend may be draining
+    if router is None:
+        return server_url
+    now = time.monotonic()
+    live = [b for b in router.backends.values() if b.available(now)]
+    return min(live, key=Backend.load).url if live else server_url
+
+
 async def orchestrate_stream(
     server_url: str,
     messages: List[Dict[str, str]],
     session_id: str = "default",
     meta: Optional[Dict[str, Any]] = None,
     stop_flag: Optional[Callable[[], bool]] = None,
+    stop_event: Optional[asyncio.Event] = None,
+    router: Optional[LoadAwareRouter] = None,
 ) -> AsyncIterator[str]:
-    domains = detect_domains(messages)
-    query = messages[-1]["content"] if messages else ""
-    recalls = await _recall(domains, query=query, k=3)
-    base_prompt = await _synthesize_persona_prompt(domains=domains, recalls=recalls, meta=meta or {})
-    final_messages = _build_final_messages(messages, meta, base_prompt)
+    """Stream one turn. With `router`, local requests go to the least-loaded backend (session-sticky)."""
+    tokens = _orchestrate_tokens(server_url, messages, session_id, meta, stop_flag, stop_event, router)
+    # meta["stream"] = {"coalesce_ms": .., "coalesce_chars": ..} batches deltas for repaint-bound consumers
+    cfg = CoalesceConfig.from_meta(meta)
+    chunks = coalesce(tokens, cfg) if cfg is not None else tokens
+    async for chunk in chunks:
+        yield chunk
 
-    # Persist turn start (with UI/gen snapshot)
-    try:
-        title_guess = None
-        for m in messages:
-            if m.get("role") == "user" and m.get("content"):
-                title_guess = (m.get("content").strip() or "")[0:48]
-                break
-        upsert_session(session_id, title=title_guess or session_id)
-        if messages and messages[-1].get("role") == "user":
-            utext = messages[-1].get("content", "")
-            add_message(session_id, "user", utext, meta or {})
-            try:
-                agent_manager.emit_event("on_chat_turn_saved", {"session_id": session_id, "message": {"role": "user", "content": utext}})
-            except Exception:
-                pass
-        add_params(session_id, {
-            "domains": domains,
-            "system_prompt": final_messages[0]["content"] if final_messages and final_messages[0].get("role") == "system" else None,
-            "ui": (meta or {}).get("ui_options") if meta else None,
-            "gen": (meta or {}).get("gen") if meta else None,
-        })
-    except Exception:
-        pass
 
+async def _orchestrate_tokens(
+    server_url: str,
+    messages: List[Dict[str, str]],
+    session_id: str,
+    meta: Optional[Dict[str, Any]],
+    stop_flag: Optional[Callable[[], bool]],
+    stop_event: Optional[asyncio.Event],
+    router: Optional[LoadAwareRouter] = None,
+) -> AsyncIterator[str]:
+    server_url = _base_url(server_url, router)
     gen = _map_gen_params((meta or {}).get("gen") if meta else None)
     source = (meta or {}).get("source") or "local"
+    compaction = CompactionPolicy.from_meta(meta)
+    prompt_messages = await _summarized(session_id, messages, compaction, meta)
+    domains, final_messages, context_plan = await _prepare(server_url if source != "openrouter" else None,
+                                                           prompt_messages, session_id, meta, gen)
+
+    # Persist turn start (with UI/gen snapshot) off the critical path; the upstream
+    # request goes out as soon as the system prompt is ready.
+    persisted = _track_persist(session_id, _spawn(_after(None, _persist_turn_start, session_id, messages, meta, domains,
+                                                         final_messages, context_plan)))
+
     assembled: List[str] = []
+    plain_gen = dict(gen)
+    should_stop = stop_flag
+    if stop_event is not None:
+        should_stop = lambda: stop_event.is_set() or bool(stop_flag and stop_flag())  # noqa: E731
     if source == "openrouter":
         orc = (meta or {}).get("openrouter") or {}
         api_key = orc.get("api_key", "")
@@ -171,47 +495,176 @@ async def orchestrate_stream(
         providers = orc.get("providers") or None
         allow_fallback_models = orc.get("allow_fallback_models")
         allow_fallback_providers = orc.get("allow_fallback_providers")
-        async for tok in stream_openrouter(api_key, model, final_messages, gen=gen,
-                                           providers=providers,
-                                           allow_fallback_models=allow_fallback_models,
-                                           allow_fallback_providers=allow_fallback_providers,
-                                           stop_flag=stop_flag):
-            if stop_flag and stop_flag():
-                break
-            assembled.append(tok)
-            yield tok
+
+        def open_primary() -> AsyncIterator[str]:
+            return stream_openrouter(api_key, model, final_messages, gen=gen,
+                                     providers=providers,
+                                     allow_fallback_models=allow_fallback_models,
+                                     allow_fallback_providers=allow_fallback_providers,
+                                     stop_flag=should_stop)
     else:
-        async for tok in stream_chat(server_url, final_messages, gen=gen, stop_flag=stop_flag):
-            assembled.append(tok)
-            yield tok
+        if _prefix_stable(meta):
+            gen.update(_slot_params(session_id, meta))
 
-    # Save assistant final
-    try:
-        if assembled:
-            add_message(session_id, "assistant", "".join(assembled), {"route": {"mode": "llama_server", "domains": domains}})
-    except Exception:
-        pass
+        def open_primary() -> AsyncIterator[str]:
+            if router is not None:
+                return stream_with_failover(
+                    router, session_id, int(gen.get("max_tokens") or 0),
+                    lambda url: stream_chat(url, final_messages, gen=gen, stop_flag=stop_flag, stop_event=stop_event))
+            return stream_chat(server_url, final_messages, gen=gen, stop_flag=stop_flag, stop_event=stop_event)
 
+    # meta["hedge"] = {"ttft_s": .., "url"|"profile": ..}: race a backup if the first token is late
+    hedge = (meta or {}).get("hedge")
+    backup = _hedge_backup(hedge, router, final_messages, plain_gen, should_stop, stop_flag, stop_event) if isinstance(hedge, dict) else None
+    upstream = hedged_stream(open_primary, backup, float(hedge.get("ttft_s", 2.0))) if backup else open_primary()
+    async for tok in upstream:
+        if source == "openrouter" and should_stop and should_stop():
+            break
+        assembled.append(tok)
+        yield tok
 
-async def orchestrate_once(server_url: str, messages: List[Dict[str, str]], session_id: str = "default", meta: Optional[Dict[str, Any]] = None) -> str:
-    domains = detect_domains(messages)
-    query = messages[-1]["content"] if messages else ""
-    recalls = await _recall(domains, query=query, k=3)
-    base_prompt = await _synthesize_persona_prompt(domains=domains, recalls=recalls, meta=meta or {})
-    final_messages = _build_final_messages(messages, meta, base_prompt)
+    # Save assistant final (after the turn-start rows so ordering in the DB is preserved)
+    if assembled:
+        saved = _track_persist(session_id, _spawn(_after(persisted, add_message, session_id, "assistant", "".join(assembled),
+                                                         {"route": {"mode": "llama_server", "domains": domains}})))
+        if compaction is not None:
+            _spawn(_compact_after(saved, server_url, session_id, compaction, meta))
+
+
+async def orchestrate_once(server_url: str, messages: List[Dict[str, str]], session_id: str = "default", meta: Optional[Dict[str, Any]] = None,
+                           router: Optional[LoadAwareRouter] = None, query_embedding: Optional[List[float]] = None) -> str:
+    server_url = _base_url(server_url, router)
     gen = _map_gen_params((meta or {}).get("gen") if meta else None)
     source = (meta or {}).get("source") or "local"
-    if source == "openrouter":
-        orc = (meta or {}).get("openrouter") or {}
-        api_key = orc.get("api_key", "")
-        model = orc.get("model", "openrouter/auto")
-        out = await once_openrouter(api_key, model, final_messages, gen=gen)
+    compaction = CompactionPolicy.from_meta(meta)
+    prompt_messages = await _summarized(session_id, messages, compaction, meta)
+    domains, final_messages, _ = await _prepare(server_url if source != "openrouter" else None,
+                                                prompt_messages, session_id, meta, gen, qvec=query_embedding)
+    plain_gen = dict(gen)
+
+    async def _call() -> str:
+        if source == "openrouter":
+            orc = (meta or {}).get("openrouter") or {}
+            api_key = orc.get("api_key", "")
+            model = orc.get("model", "openrouter/auto")
+            return await once_openrouter(api_key, model, final_messages, gen=gen)
+        if _prefix_stable(meta):
+            gen.update(_slot_params(session_id, meta))
+        if router is not None:
+            return await call_with_failover(router, session_id, int(gen.get("max_tokens") or 0),
+                                            lambda url: once_chat(url, final_messages, gen=gen))
+        return await once_chat(server_url, final_messages, gen=gen)
+
+    # Greedy sampling is replayable: serve identical requests from the on-disk cache
+    # (meta["response_cache"] = False opts out)
+    cache = get_response_cache() if is_deterministic(plain_gen) and (meta or {}).get("response_cache", True) else None
+    model_id = None
+    if cache is not None:
+        model_id = await _cache_model_id(source, meta, server_url, router)
+    if cache is not None and model_id is not None:
+        out = await cache.get_or_compute(cache_key(final_messages, plain_gen, model_id), _call)
     else:
-        out = await once_chat(server_url, final_messages, gen=gen)
+        out = await _call()
+    saved = _track_persist(session_id, _spawn(_after(None, _persist_once, session_id, messages, meta, domains, out)))
+    if compaction is not None:
+        _spawn(_compact_after(saved, server_url, session_id, compaction, meta))
+    return out
+
+
+@dataclass
+class JobResult:
+    index: int                      # position of the job in the input
+    session_id: str
+    output: Optional[str] = None
+    error: Optional[BaseException] = None
+    elapsed_s: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+async def _backend_slots(server_url: str, router: Optional[LoadAwareRouter]) -> int:
+    """Parallel decode slots behind `server_url` (llama-server -np), or summed across the router."""
+    if router is not None:
+        if any(b.slots_total is None for b in router.backends.values()):
+            await router.poll_once()
+        now = time.monotonic()
+        return max(1, sum(b.slots_total or 1 for b in router.backends.values() if b.available(now)))
+    base = server_url.rstrip("/")
     try:
-        upsert_session(session_id)
-        add_message(session_id, "user", messages[-1].get("content", "") if messages else "", meta or {})
-        add_message(session_id, "assistant", out, {"route": {"mode": "llama_server", "domains": domains}})
+        r = await get_client(base).get(base + "/props", timeout=3.0)
+        if r.status_code == 200 and (r.json() or {}).get("total_slots"):
+            return max(1, int(r.json()["total_slots"]))
     except Exception:
         pass
-    return out
+    return 1
+
+
+async def _embed_queries(jobs: List[Tuple[str, List[Dict[str, str]], Optional[Dict[str, Any]]]]) -> Dict[str, List[float]]:
+    """One embed_batch pass over the distinct last-message queries of all jobs."""
+    if get_embedder is None:
+        return {}
+    queries = list(dict.fromkeys(m[-1].get("content") or "" for _, m, _ in jobs if m))
+    queries = [q for q in queries if q]
+    if not queries:
+        return {}
+    try:
+        vecs = await get_embedder().embed_batch(queries)
+    except Exception:
+        return {}  # recall falls back to per-job embed_one
+    return dict(zip(queries, vecs))
+
+
+async def orchestrate_many(server_url: str, jobs: Iterable[Tuple[str, List[Dict[str, str]], Optional[Dict[str, Any]]]],
+                           concurrency: Optional[int] = None,
+                           router: Optional[LoadAwareRouter] = None) -> AsyncIterator[JobResult]:
+    """Run many (session_id, messages, meta) jobs through orchestrate_once; yield results as they finish.
+
+    At most `concurrency` jobs are in flight, defaulting to the backend's parallel
+    slots (more would only queue inside llama-server). A failing job yields a
+    JobResult with `error` set and does not stop the others. Pass `concurrency`
+    explicitly for remote (OpenRouter) jobs.
+    """
+    pending = list(jobs)
+    if not pending:
+        return
+    if concurrency is None:
+        concurrency = await _backend_slots(_base_url(server_url, router), router)
+    qvecs = await _embed_queries(pending)
+    todo: asyncio.Queue = asyncio.Queue()
+    for i, job in enumerate(pending):
+        todo.put_nowait((i, job))
+    results: asyncio.Queue = asyncio.Queue()
+    closing = asyncio.Event()
+
+    async def _worker() -> None:
+        while not closing.is_set():
+            try:
+                i, (session_id, messages, meta) = todo.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            t0 = time.perf_counter()
+            res = JobResult(index=i, session_id=session_id)
+            try:
+                query = (messages[-1].get("content") or "") if messages else ""
+                res.output = await orchestrate_once(server_url, messages, session_id=session_id, meta=meta,
+                                                    router=router, query_embedding=qvecs.get(query))
+            except asyncio.CancelledError as e:
+                if closing.is_set():
+                    raise
+                res.error = e  # cancelled inside the job (e.g. a shared cache call), not by the consumer
+            except Exception as e:
+                res.error = e
+            res.elapsed_s = time.perf_counter() - t0
+            results.put_nowait(res)
+
+    workers = [asyncio.ensure_future(_worker()) for _ in range(max(1, min(int(concurrency), len(pending))))]
+    try:
+        for _ in range(len(pending)):
+            yield await results.get()
+    finally:
+        closing.set()
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .config import CONFIG_DIR
+from .http_pool import get_client
+
+
+RESPONSE_CACHE_PATH = CONFIG_DIR / "responses.db"
+
+
+def is_deterministic(gen: Optional[Dict[str, Any]]) -> bool:
+    """Only greedy sampling is safe to replay from cache."""
+    g = gen or {}
+    temp = g.get("temperature")
+    return (temp is not None and float(temp) == 0.0) or g.get("top_k") == 1
+
+
+def cache_key(messages: List[Dict[str, Any]], gen: Dict[str, Any], model: str) -> str:
+    blob = json.dumps({"messages": messages, "gen": gen, "model": model}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+_MODEL_IDS: Dict[str, Tuple[float, str]] = {}
+
+
+async def local_model_id(server_url: str, ttl: float = 30.0) -> str:
+    """Identity of the model loaded behind `server_url` (from /v1/models), so swaps change the key.
+
+    Falls back to the URL itself when the server does not answer.
+    """
+    now = time.monotonic()
+    hit = _MODEL_IDS.get(server_url)
+    if hit and now - hit[0] < ttl:
+        return hit[1]
+    try:
+        url = server_url.rstrip("/") + "/v1/models"
+        r = await get_client(url).get(url, timeout=3.0)
+        data = (r.json() or {}).get("data") or []
+        if data and data[0].get("id"):
+            ident = str(data[0]["id"])
+            _MODEL_IDS[server_url] = (now, ident)
+            return ident
+    except Exception:
+        pass
+    # Not remembered: a server that is still loading must not pin the URL as its identity
+    return server_url
+
+
+class ResponseCache:
+    """On-disk LRU of final responses, bounded by total bytes.
+
+    Concurrent misses for the same key share one upstream call.
+    """
+
+    def __init__(self, path: Path = RESPONSE_CACHE_PATH, max_bytes: int = 64 * 1024 * 1024):
+        self.path = Path(path)
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._inflight: Dict[str, "asyncio.Task[str]"] = {}
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._con = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                size INTEGER,
+                created REAL,
+                last_access REAL
+            )
+            """
+        )
+        self._con.execute("CREATE INDEX IF NOT EXISTS idx_responses_access ON responses(last_access)")
+        self._con.commit()
+        self._total = self._con.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._con.execute("SELECT value FROM responses WHERE key=?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._con.execute("UPDATE responses SET last_access=? WHERE key=?", (time.time(), key))
+            self._con.commit()
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            old = self._con.execute("SELECT size FROM responses WHERE key=?", (key,)).fetchone()
+            self._con.execute(
+                "INSERT OR REPLACE INTO responses(key, value, size, created, last_access) VALUES(?,?,?,?,?)",
+                (key, value, size, now, now),
+            )
+            self._total += size - (old[0] if old else 0)
+            if self._total > self.max_bytes:
+                # Oldest-accessed first until back under the cap
+                victims = []
+                for k, sz in self._con.execute("SELECT key, size FROM responses ORDER BY last_access ASC"):
+                    if self._total <= self.max_bytes:
+                        break
+                    if k == key:
+                        continue
+                    victims.append((k,))
+                    self._total -= sz
+                self._con.executemany("DELETE FROM responses WHERE key=?", victims)
+            self._con.commit()
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[str]]) -> str:
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            # Owned by the cache, not the first caller: cancelling one caller must not cancel the others
+            task = asyncio.ensure_future(self._compute(key, compute))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task)
+
+    async def _compute(self, key: str, compute: Callable[[], Awaitable[str]]) -> str:
+        cached = await asyncio.to_thread(self.get, key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        out = await compute()
+        if out:
+            await asyncio.to_thread(self.put, key, out)
+        return out
+
+    def _done(self, key: str, task: "asyncio.Task[str]") -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved in case every caller has gone
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced,
+                "hit_rate": (self.hits / total) if total else 0.0, "inflight": len(self._inflight)}
+
+
+_CACHE: Optional[ResponseCache] = None
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    global _CACHE
+    if _CACHE is None:
+        try:
+            _CACHE = ResponseCache()
+        except Exception:
+            return None
+    return _CACHE
@@ -0,0 +1,281 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, asdict
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, TypeVar
+
+import httpx
+
+from .http_pool import get_client
+
+
+@dataclass
+class Backend:
+    url: str
+    healthy: bool = True
+    draining: bool = False
+    outstanding: int = 0               # in-flight requests routed here
+    outstanding_tokens: int = 0        # their max_tokens budgets
+    slots_total: Optional[int] = None  # from /slots or /health
+    slots_idle: Optional[int] = None
+    polled_outstanding: int = 0        # outstanding at the time slots_idle was read
+    requests: int = 0
+    failures: int = 0
+    down_until: float = 0.0
+    last_error: Optional[str] = None
+
+    def available(self, now: float) -> bool:
+        return not self.draining and (self.healthy or now >= self.down_until)
+
+    def load(self) -> tuple:
+        """Sort key: backends with a free slot first, then fewest queued requests/tokens."""
+        if self.slots_idle is not None:
+            # requests routed since the last poll have taken slots the server has not reported yet
+            free = self.slots_idle - max(0, self.outstanding - self.polled_outstanding)
+        else:
+            free = (self.slots_total or 1) - self.outstanding
+        per_slot = self.outstanding / max(1, self.slots_total or 1)
+        return (0 if free > 0 else 1, per_slot, self.outstanding_tokens)
+
+
+class NoBackendAvailable(RuntimeError):
+    pass
+
+
+T = TypeVar("T")
+
+
+class LoadAwareRouter:
+    """Pick a llama-server endpoint per request.
+
+    Choice is by free slots and outstanding requests/tokens. A session sticks to
+    the backend holding its KV cache while that backend has room. A backend that
+    fails is taken out for `fail_cooldown` seconds, then tried again.
+    """
+
+    def __init__(self, urls: Iterable[str] = (), poll_interval: float = 1.0, fail_cooldown: float = 5.0,
+                 max_affinity: int = 4096, history: int = 200) -> None:
+        self.backends: "OrderedDict[str, Backend]" = OrderedDict()
+        for u in urls:
+            self.add(u)
+        self.poll_interval = poll_interval
+        self.fail_cooldown = fail_cooldown
+        self._affinity: "OrderedDict[str, str]" = OrderedDict()
+        self._max_affinity = max_affinity
+        self.decisions: Deque[Dict[str, Any]] = deque(maxlen=history)
+        self._poller: Optional[asyncio.Task] = None
+
+    # --- membership ---
+    def add(self, url: str) -> Backend:
+        url = url.rstrip("/")
+        b = self.backends.get(url)
+        if b is None:
+            b = self.backends[url] = Backend(url=url)
+        b.draining = False
+        return b
+
+    def remove(self, url: str) -> None:
+        self.backends.pop(url.rstrip("/"), None)
+
+    def drain(self, url: str) -> None:
+        """Stop routing new requests to `url`; in-flight ones finish normally."""
+        b = self.backends.get(url.rstrip("/"))
+        if b is not None:
+            b.draining = True
+
+    async def wait_drained(self, url: str, timeout: float = 120.0, interval: float = 0.1) -> bool:
+        """Wait until `url` has no outstanding requests; False on timeout."""
+        deadline = time.monotonic() + timeout
+        while True:
+            b = self.backends.get(url.rstrip("/"))
+            if b is None or b.outstanding <= 0:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(interval)
+
+    def set_endpoints(self, urls: Iterable[str]) -> None:
+        """Sync with a live set (e.g. LlamaServerPool.healthy_endpoints()); keeps counters for known URLs."""
+        keep = {u.rstrip("/") for u in urls}
+        for u in keep:
+            self.add(u)
+        for u in list(self.backends):
+            if u not in keep and self.backends[u].outstanding == 0:
+                self.remove(u)
+
+    # --- selection ---
+    def pick(self, session_id: Optional[str] = None, exclude: Iterable[str] = ()) -> Backend:
+        now = time.monotonic()
+        skip = set(exclude)
+        cands = [b for b in self.backends.values() if b.url not in skip and b.available(now)]
+        if not cands:
+            raise NoBackendAvailable("no healthy llama-server backend")
+        choice: Optional[Backend] = None
+        reason = "failover" if skip else "least_loaded"
+        sticky = self._affinity.get(session_id) if session_id else None
+        if sticky:
+            b = self.backends.get(sticky)
+            if b is not None and b in cands and b.load()[0] == 0:
+                choice, reason = b, "affinity"
+        if choice is None:
+            choice = min(cands, key=Backend.load)
+            if sticky and sticky != choice.url and not skip:
+                reason = "rebalanced"
+        if session_id:
+            self._affinity[session_id] = choice.url
+            self._affinity.move_to_end(session_id)
+            while len(self._affinity) > self._max_affinity:
+                self._affinity.popitem(last=False)
+        self.decisions.append({
+            "ts": time.time(), "session_id": session_id, "url": choice.url, "reason": reason,
+            "outstanding": choice.outstanding, "slots_idle": choice.slots_idle,
+        })
+        return choice
+
+    def acquire(self, session_id: Optional[str] = None, tokens: int = 0, exclude: Iterable[str] = ()) -> Backend:
+        b = self.pick(session_id, exclude=exclude)
+        b.outstanding += 1
+        b.outstanding_tokens += tokens
+        b.requests += 1
+        return b
+
+    def release(self, b: Backend, tokens: int = 0) -> None:
+        b.outstanding -= 1
+        b.outstanding_tokens -= tokens
+
+    @asynccontextmanager
+    async def lease(self, session_id: Optional[str] = None, tokens: int = 0,
+                    exclude: Iterable[str] = ()) -> AsyncIterator[Backend]:
+        """Hold a backend for one request; outstanding counters follow the lease."""
+        b = self.acquire(session_id, tokens, exclude)
+        try:
+            yield b
+        finally:
+            self.release(b, tokens)
+
+    def mark_failure(self, b: Backend, err: BaseException) -> None:
+        b.failures += 1
+        b.healthy = False
+        b.last_error = str(err) or type(err).__name__
+        b.down_until = time.monotonic() + self.fail_cooldown
+
+    def mark_success(self, b: Backend) -> None:
+        b.healthy = True
+        b.last_error = None
+
+    # --- health / slot polling ---
+    async def _poll_backend(self, b: Backend) -> None:
+        client = get_client(b.url)
+        try:
+            r = await client.get(b.url + "/slots", timeout=2.0)
+            if r.status_code == 200 and isinstance(r.json(), list):
+                slots = r.json()
+                b.slots_total = len(slots)
+                # newer builds report is_processing; older ones state (0 = idle)
+                b.slots_idle = sum(1 for s in slots if not s.get("is_processing", s.get("state", 0) != 0))
+                b.polled_outstanding = b.outstanding
+                self.mark_success(b)
+                return
+            r = await client.get(b.url + "/health", timeout=2.0)
+            if r.status_code != 200:
+                raise RuntimeError(f"/health {r.status_code}")
+            data = r.json() if r.content else {}
+            if "slots_idle" in data:
+                b.slots_idle = int(data["slots_idle"])
+                b.slots_total = int(data.get("slots_idle", 0)) + int(data.get("slots_processing", 0))
+                b.polled_outstanding = b.outstanding
+            self.mark_success(b)
+        except Exception as e:
+            self.mark_failure(b, e)
+
+    async def poll_once(self) -> None:
+        await asyncio.gather(*(self._poll_backend(b) for b in list(self.backends.values())))
+
+    async def _poll_loop(self) -> None:
+        while True:
+            try:
+                await self.poll_once()
+            except Exception:
+                pass
+            await asyncio.sleep(self.poll_interval)
+
+    def start_polling(self) -> asyncio.Task:
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.ensure_future(self._poll_loop())
+        return self._poller
+
+    def stop_polling(self) -> None:
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backends": [asdict(b) for b in self.backends.values()],
+            "recent_decisions": list(self.decisions)[-20:],
+        }
+
+
+def _backend_fault(e: BaseException) -> bool:
+    """Errors that say the backend is down or broken; 4xx (e.g. a context overflow) is the request's fault."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500
+    return isinstance(e, (httpx.ConnectError, httpx.TimeoutException, httpx.RemoteProtocolError))
+
+
+async def stream_with_failover(router: LoadAwareRouter, session_id: Optional[str], tokens: int,
+                               open_stream: Callable[[str], AsyncIterator[str]]) -> AsyncIterator[str]:
+    """Stream from a routed backend, moving to the next one if it fails before the first token."""
+    tried: List[str] = []
+    last_err: Optional[BaseException] = None
+    while True:
+        try:
+            b = router.acquire(session_id, tokens, exclude=tried)
+        except NoBackendAvailable:
+            if last_err is not None:
+                raise last_err
+            raise
+        started = False
+        try:
+            async for tok in open_stream(b.url):
+                started = True
+                yield tok
+            router.mark_success(b)
+            return
+        except Exception as e:
+            if started or not _backend_fault(e):
+                raise
+            router.mark_failure(b, e)
+            tried.append(b.url)
+            last_err = e
+        finally:
+            router.release(b, tokens)
+
+
+async def call_with_failover(router: LoadAwareRouter, session_id: Optional[str], tokens: int,
+                             call: Callable[[str], Awaitable[T]]) -> T:
+    """Non-streaming counterpart of stream_with_failover."""
+    tried: List[str] = []
+    last_err: Optional[BaseException] = None
+    while True:
+        try:
+            b = router.acquire(session_id, tokens, exclude=tried)
+        except NoBackendAvailable:
+            if last_err is not None:
+                raise last_err
+            raise
+        try:
+            out = await call(b.url)
+            router.mark_success(b)
+            return out
+        except Exception as e:
+            if not _backend_fault(e):
+                raise
+            router.mark_failure(b, e)
+            tried.append(b.url)
+            last_err = e
+        finally:
+            router.release(b, tokens)
@@ -1,170 +1,763 @@
 from __future__ import annotations
 
+import asyncio
+import atexit
+import hashlib
 import json
+import queue
+import re
 import sqlite3
+import threading
 import time
+import zlib
+from concurrent.futures import Future
+from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
 
 from .config import CONFIG_DIR
 
+# zstd is optional; blobs record their codec so either build can read what it wrote
+try:
+    import zstandard
+except Exception:
+    zstandard = None  # type: ignore
+
 
 DB_PATH = CONFIG_DIR / "chat.db"
 
+T = TypeVar("T")
+
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        created_at REAL,
+        updated_at REAL,
+        title TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT,
+        role TEXT,
+        content TEXT,
+        ts REAL,
+        meta TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS params (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT,
+        ts REAL,
+        data TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS summaries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT,
+        start_id INTEGER,
+        end_id INTEGER,
+        n_messages INTEGER,
+        summary TEXT,
+        ts REAL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS token_counts (
+        model TEXT,
+        hash TEXT,
+        n INTEGER,
+        PRIMARY KEY (model, hash)
+    )
+    """,
+]
+
+
+def _m1_indexes(con: sqlite3.Connection) -> None:
+    con.execute("CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_params_session ON params(session_id, id)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_summaries_session ON summaries(session_id, end_id)")
+
+
+# --- content-addressed params storage ---
+# A params row points at a manifest blob: {key: ["json", hash] | ["text", [hash, ...]]}.
+# Long strings (the system prompt) are split at paragraph boundaries so the static
+# layers are stored once however much the per-turn tail changes.
+_CHUNK_MIN = 1024
+_RAW_MAX = 64
+
+
+def _blob_hash(raw: bytes) -> str:
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def _pack(raw: bytes) -> Tuple[str, bytes]:
+    if len(raw) <= _RAW_MAX:
+        return "raw", raw
+    if zstandard is not None:
+        packed, codec = zstandard.ZstdCompressor(level=6).compress(raw), "zstd"
+    else:
+        packed, codec = zlib.compress(raw, 6), "zlib"
+    return (codec, packed) if len(packed) < len(raw) else ("raw", raw)
+
+
+def _unpack(codec: str, data: bytes) -> bytes:
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("params blob is zstd-compressed but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def _chunks(text: str) -> List[str]:
+    out: List[str] = []
+    cur = ""
+    for para in re.split(r"(?<=\n\n)", text):
+        cur += para
+        if len(cur) >= _CHUNK_MIN:
+            out.append(cur)
+            cur = ""
+    if cur or not out:
+        out.append(cur)
+    return out
+
+
+def _encode_params(data: Dict[str, Any]) -> Tuple[str, List[Tuple[str, str, int, bytes]]]:
+    """Manifest hash and the (hash, codec, size, data) blob rows for one params snapshot."""
+    blobs: Dict[str, Tuple[str, str, int, bytes]] = {}
+
+    def put(raw: bytes) -> str:
+        h = _blob_hash(raw)
+        if h not in blobs:
+            codec, packed = _pack(raw)
+            blobs[h] = (h, codec, len(raw), packed)
+        return h
+
+    manifest: Dict[str, Any] = {}
+    for k, v in (data or {}).items():
+        if isinstance(v, str) and len(v) > _CHUNK_MIN:
+            manifest[k] = ["text", [put(c.encode("utf-8")) for c in _chunks(v)]]
+        else:
+            manifest[k] = ["json", put(json.dumps(v, sort_keys=True).encode("utf-8"))]
+    root = put(json.dumps(manifest, sort_keys=True).encode("utf-8"))
+    return root, list(blobs.values())
+
+
+def _insert_blobs(con: sqlite3.Connection, rows: List[Tuple[str, str, int, bytes]]) -> None:
+    con.executemany("INSERT OR IGNORE INTO blobs(hash, codec, size, data) VALUES(?,?,?,?)", rows)
+
+
+class _BlobReader:
+    """Decodes params rows; caches blobs for the life of one read, since consecutive snapshots share most of them."""
 
-def _conn():
-    CONFIG_DIR.mkdir(parents=True, exist_ok=True)
-    con = sqlite3.connect(str(DB_PATH))
+    def __init__(self, con: sqlite3.Connection) -> None:
+        self._con = con
+        self._cache: Dict[str, bytes] = {}
+
+    def _get(self, h: str) -> bytes:
+        raw = self._cache.get(h)
+        if raw is None:
+            r = self._con.execute("SELECT codec, data FROM blobs WHERE hash=?", (h,)).fetchone()
+            if r is None:
+                raise KeyError(f"missing params blob {h}")
+            raw = self._cache[h] = _unpack(r["codec"], r["data"])
+        return raw
+
+    def params(self, r: sqlite3.Row) -> Dict[str, Any]:
+        if r["blob"] is None:
+            return json.loads(r["data"] or "{}")
+        out: Dict[str, Any] = {}
+        for k, (kind, ref) in json.loads(self._get(r["blob"])).items():
+            if kind == "text":
+                out[k] = b"".join(self._get(h) for h in ref).decode("utf-8")
+            else:
+                out[k] = json.loads(self._get(ref))
+        return out
+
+
+def _m2_params_blobs(con: sqlite3.Connection) -> None:
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            codec TEXT,
+            size INTEGER,
+            data BLOB
+        )
+        """
+    )
+    cols = {r[1] for r in con.execute("PRAGMA table_info(params)")}
+    if "blob" not in cols:
+        con.execute("ALTER TABLE params ADD COLUMN blob TEXT")
+    # Existing inline snapshots stay readable as they are; compact_params() moves them into blobs
+
+
+def _compact_params_page(con: sqlite3.Connection, after_id: int, limit: int) -> Tuple[int, int]:
+    """Move one page of inline params snapshots into blobs; returns (last id seen, rows moved)."""
+    rows = con.execute(
+        "SELECT id, data FROM params WHERE id>? AND blob IS NULL ORDER BY id LIMIT ?", (after_id, limit)
+    ).fetchall()
+    moved = 0
+    for r in rows:
+        try:
+            data = json.loads(r[1] or "{}")
+        except ValueError:
+            continue  # leave unreadable rows inline
+        root, blobs = _encode_params(data)
+        _insert_blobs(con, blobs)
+        con.execute("UPDATE params SET blob=?, data=NULL WHERE id=?", (root, r[0]))
+        moved += 1
+    return (rows[-1][0] if rows else 0), moved
+
+
+# --- full-text search ---
+# External-content FTS5 index over messages.content, kept in step by triggers
+_FTS_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+
+
+def _create_fts(con: sqlite3.Connection) -> bool:
+    """Create the index and its triggers; False when this SQLite build has no FTS5."""
+    try:
+        for stmt in _FTS_SCHEMA:
+            con.execute(stmt)
+        return True
+    except sqlite3.OperationalError as e:
+        if "fts5" in str(e):
+            return False
+        raise
+
+
+def _m3_messages_fts(con: sqlite3.Connection) -> None:
+    if _create_fts(con):
+        con.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+
+# Applied in order; PRAGMA user_version records how many have run
+_MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _m1_indexes,
+    _m2_params_blobs,
+    _m3_messages_fts,
+]
+
+
+def _migrate(con: sqlite3.Connection) -> None:
+    while True:
+        # Version is re-read under the write lock so two processes never run a step twice
+        con.execute("BEGIN IMMEDIATE")
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(_MIGRATIONS):
+            con.execute("COMMIT")
+            return
+        try:
+            _MIGRATIONS[version](con)
+            con.execute(f"PRAGMA user_version={version + 1}")
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+
+
+def _open(path: Path) -> sqlite3.Connection:
+    # Autocommit mode: the writer issues BEGIN/COMMIT itself to group writes.
+    # The statement cache keeps the fixed SQL below prepared for the connection's life.
+    con = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None, cached_statements=256)
     con.row_factory = sqlite3.Row
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA busy_timeout=5000")
     return con
 
 
+class SessionStore:
+    """Long-lived connections to the chat DB.
+
+    Writes are queued to one writer thread, which commits whatever has piled up
+    in a single transaction, so a streamed turn costs one commit and not one per
+    call. Reads use their own connection and first wait for queued writes,
+    so a caller always sees what it wrote. Pending writes are flushed on close()
+    and at interpreter exit.
+    """
+
+    _BARRIER = object()
+
+    def __init__(self, path: Path = DB_PATH, batch_max: int = 256) -> None:
+        self.path = Path(path)
+        self.batch_max = batch_max
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._wcon = _open(self.path)
+        for stmt in _SCHEMA:
+            self._wcon.execute(stmt)
+        _migrate(self._wcon)
+        self._rcon = _open(self.path)
+        self._rlock = threading.Lock()
+        self._queue: "queue.Queue[Optional[Tuple[Any, tuple, Future]]]" = queue.Queue()
+        self._pending = 0
+        self._plock = threading.Lock()
+        self.commits = 0
+        self.writes = 0
+        self.closed = False
+        self._thread = threading.Thread(target=self._run, name="sessions-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # --- writer ---
+    def submit(self, fn: Callable[..., Any], *args: Any) -> Future:
+        """Queue `fn(con, *args)` for the writer thread; the future resolves once committed."""
+        if self.closed:
+            raise RuntimeError("session store is closed")
+        fut: Future = Future()
+        with self._plock:
+            self._pending += 1
+        self._queue.put((fn, args, fut))
+        return fut
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            while len(batch) < self.batch_max:
+                try:
+                    nxt = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    stop = True
+                    break
+                batch.append(nxt)
+            self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch: List[Tuple[Any, tuple, Future]]) -> None:
+        results: List[Tuple[Future, Any, Optional[BaseException]]] = []
+        work = [b for b in batch if b[0] is not SessionStore._BARRIER]
+        try:
+            if work:
+                self._wcon.execute("BEGIN")
+            for fn, args, fut in batch:
+                if fn is SessionStore._BARRIER:
+                    results.append((fut, None, None))
+                    continue
+                # Savepoint per write: one that fails partway does not sink the batch or leave half its rows
+                self._wcon.execute("SAVEPOINT w")
+                try:
+                    res = fn(self._wcon, *args)
+                except Exception as e:
+                    self._wcon.execute("ROLLBACK TO w")
+                    self._wcon.execute("RELEASE w")
+                    results.append((fut, None, e))
+                else:
+                    self._wcon.execute("RELEASE w")
+                    results.append((fut, res, None))
+            if work:
+                self._wcon.execute("COMMIT")
+                self.commits += 1
+                self.writes += len(work)
+        except Exception as e:
+            try:
+                self._wcon.execute("ROLLBACK")
+            except Exception:
+                pass
+            results = [(fut, None, e) for _, _, fut in batch]
+        finally:
+            with self._plock:
+                self._pending -= len(batch)
+        for fut, res, err in results:
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(res)
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """Block until every write queued so far is committed."""
+        if self.closed or not self._pending:
+            return
+        self.submit(SessionStore._BARRIER).result(timeout)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+        self._queue.put(None)
+        self._thread.join()
+        for con in (self._wcon, self._rcon):
+            try:
+                con.close()
+            except Exception:
+                pass
+
+    # --- reader ---
+    def read(self, fn: Callable[..., T], *args: Any) -> T:
+        """Run `fn(con, *args)` on the read connection after pending writes land."""
+        self.flush()
+        with self._rlock:
+            return fn(self._rcon, *args)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"pending": self._pending, "commits": self.commits, "writes": self.writes,
+                "writes_per_commit": (self.writes / self.commits) if self.commits else 0.0}
+
+
+_STORE: Optional[SessionStore] = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    global _STORE
+    with _STORE_LOCK:
+        if _STORE is None or _STORE.closed:
+            _STORE = SessionStore(DB_PATH)
+        return _STORE
+
+
 def ensure_db():
-    with _conn() as con:
-        cur = con.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS sessions (
-                id TEXT PRIMARY KEY,
-                created_at REAL,
-                updated_at REAL,
-                title TEXT
-            )
-            """
-        )
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id TEXT,
-                role TEXT,
-                content TEXT,
-                ts REAL,
-                meta TEXT
-            )
-            """
-        )
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS params (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id TEXT,
-                ts REAL,
-                data TEXT
-            )
-            """
-        )
-        con.commit()
-
-
-def upsert_session(session_id: str, title: str = ""):
-    ensure_db()
-    now = time.time()
-    with _conn() as con:
-        cur = con.cursor()
-        cur.execute("SELECT id FROM sessions WHERE id=?", (session_id,))
-        if cur.fetchone() is None:
-            cur.execute(
-                "INSERT INTO sessions(id, created_at, updated_at, title) VALUES(?,?,?,?)",
-                (session_id, now, now, title or session_id),
-            )
-        else:
-            cur.execute("UPDATE sessions SET updated_at=? WHERE id=?", (now, session_id))
-        con.commit()
-
-
-def add_message(session_id: str, role: str, content: str, meta: Optional[Dict[str, Any]] = None):
-    ensure_db()
-    now = time.time()
-    with _conn() as con:
-        cur = con.cursor()
-        cur.execute(
-            "INSERT INTO messages(session_id, role, content, ts, meta) VALUES(?,?,?,?,?)",
-            (session_id, role, content, now, json.dumps(meta or {})),
-        )
-        cur.execute("UPDATE sessions SET updated_at=? WHERE id=?", (now, session_id))
-        con.commit()
-
-
-def add_params(session_id: str, data: Dict[str, Any]):
-    ensure_db()
-    now = time.time()
-    with _conn() as con:
-        cur = con.cursor()
-        cur.execute(
-            "INSERT INTO params(session_id, ts, data) VALUES(?,?,?)",
-            (session_id, now, json.dumps(data or {})),
+    """Open the store (creating the schema on first use)."""
+    get_session_store()
+
+
+def flush():
+    """Wait until all queued session writes are committed."""
+    get_session_store().flush()
+
+
+def _write(fn: Callable[..., Any], *args: Any) -> Future:
+    return get_session_store().submit(fn, *args)
+
+
+def _read(fn: Callable[..., T], *args: Any) -> T:
+    return get_session_store().read(fn, *args)
+
+
+def _upsert_session(con: sqlite3.Connection, session_id: str, title: str, now: float) -> None:
+    con.execute(
+        "INSERT INTO sessions(id, created_at, updated_at, title) VALUES(?,?,?,?) "
+        "ON CONFLICT(id) DO UPDATE SET updated_at=excluded.updated_at",
+        (session_id, now, now, title or session_id),
+    )
+
+
+def upsert_session(session_id: str, title: str = "") -> Future:
+    return _write(_upsert_session, session_id, title, time.time())
+
+
+def _add_message(con: sqlite3.Connection, session_id: str, role: str, content: str, meta: str, now: float) -> int:
+    cur = con.execute(
+        "INSERT INTO messages(session_id, role, content, ts, meta) VALUES(?,?,?,?,?)",
+        (session_id, role, content, now, meta),
+    )
+    con.execute("UPDATE sessions SET updated_at=? WHERE id=?", (now, session_id))
+    return cur.lastrowid
+
+
+def add_message(session_id: str, role: str, content: str, meta: Optional[Dict[str, Any]] = None) -> Future:
+    """Queue a message; the returned future resolves to its row id once committed."""
+    return _write(_add_message, session_id, role, content, json.dumps(meta or {}), time.time())
+
+
+def _add_params(con: sqlite3.Connection, session_id: str, root: str, blobs: List[Tuple[str, str, int, bytes]],
+                now: float) -> None:
+    _insert_blobs(con, blobs)
+    con.execute("INSERT INTO params(session_id, ts, blob) VALUES(?,?,?)", (session_id, now, root))
+    con.execute("UPDATE sessions SET updated_at=? WHERE id=?", (now, session_id))
+
+
+def add_params(session_id: str, data: Dict[str, Any]) -> Future:
+    # Hashing and compression happen on the caller's thread; the writer only inserts
+    root, blobs = _encode_params(data or {})
+    return _write(_add_params, session_id, root, blobs, time.time())
+
+
+def _get_summary(con: sqlite3.Connection, session_id: str) -> Dict[str, Any]:
+    row = con.execute(
+        "SELECT start_id, end_id, n_messages, summary, ts FROM summaries WHERE session_id=? ORDER BY end_id DESC LIMIT 1",
+        (session_id,),
+    ).fetchone()
+    return dict(row) if row else {}
+
+
+def get_summary(session_id: str) -> Dict[str, Any]:
+    """Latest rolling summary: covers messages start_id..end_id (the first n_messages of the session)."""
+    return _read(_get_summary, session_id)
+
+
+def _add_summary(con: sqlite3.Connection, session_id: str, start_id: int, end_id: int, n_messages: int,
+                 summary: str, now: float) -> None:
+    con.execute(
+        "INSERT INTO summaries(session_id, start_id, end_id, n_messages, summary, ts) VALUES(?,?,?,?,?,?)",
+        (session_id, start_id, end_id, n_messages, summary, now),
+    )
+
+
+def add_summary(session_id: str, start_id: int, end_id: int, n_messages: int, summary: str) -> Future:
+    return _write(_add_summary, session_id, start_id, end_id, n_messages, summary, time.time())
+
+
+def _messages_after(con: sqlite3.Connection, session_id: str, after_id: int) -> List[Dict[str, Any]]:
+    cur = con.execute(
+        "SELECT id, role, content FROM messages WHERE session_id=? AND id>? ORDER BY id ASC",
+        (session_id, after_id),
+    )
+    return [dict(r) for r in cur.fetchall()]
+
+
+def messages_after(session_id: str, after_id: int = 0) -> List[Dict[str, Any]]:
+    return _read(_messages_after, session_id, after_id)
+
+
+def _message_row(r: sqlite3.Row) -> Dict[str, Any]:
+    return {"id": r["id"], "role": r["role"], "content": r["content"], "ts": r["ts"], "meta": json.loads(r["meta"] or "{}")}
+
+
+def _messages_page(con: sqlite3.Connection, session_id: str, after_id: int, limit: int) -> List[Dict[str, Any]]:
+    cur = con.execute(
+        "SELECT id, role, content, ts, meta FROM messages WHERE session_id=? AND id>? ORDER BY id ASC LIMIT ?",
+        (session_id, after_id, limit),
+    )
+    return [_message_row(r) for r in cur.fetchall()]
+
+
+def iter_messages(session_id: str, after_id: int = 0, limit: Optional[int] = None,
+                  page_size: int = 500) -> Iterator[Dict[str, Any]]:
+    """Messages with id > after_id in order, fetched a page at a time (keyset on id).
+
+    Only one page is held in memory, and the read connection is released between
+    pages. Resume from the last yielded "id".
+    """
+    left = limit if limit is not None else -1
+    while left != 0:
+        n = page_size if left < 0 else min(page_size, left)
+        page = _read(_messages_page, session_id, after_id, n)
+        yield from page
+        if len(page) < n:
+            return
+        after_id = page[-1]["id"]
+        if left > 0:
+            left -= len(page)
+
+
+def _last_messages(con: sqlite3.Connection, session_id: str, n: int) -> List[Dict[str, Any]]:
+    cur = con.execute(
+        "SELECT id, role, content, ts, meta FROM messages WHERE session_id=? ORDER BY id DESC LIMIT ?",
+        (session_id, n),
+    )
+    return [_message_row(r) for r in reversed(cur.fetchall())]
+
+
+def last_messages(session_id: str, n: int = 20) -> List[Dict[str, Any]]:
+    """The newest `n` messages of a session, oldest first."""
+    return _read(_last_messages, session_id, n)
+
+
+def _latest_params(con: sqlite3.Connection, session_id: str, keys: Tuple[str, ...]) -> Dict[str, Any]:
+    # Newest first; the cursor steps lazily, so this stops at the first rows that cover `keys`
+    cur = con.execute("SELECT ts, data, blob FROM params WHERE session_id=? ORDER BY id DESC", (session_id,))
+    blobs = _BlobReader(con)
+    if not keys:
+        r = cur.fetchone()
+        return {"ts": r["ts"], "data": blobs.params(r)} if r else {}
+    found: Dict[str, Any] = {}
+    for r in cur:
+        data = blobs.params(r)
+        for k in keys:
+            if k not in found and data.get(k):
+                found[k] = data[k]
+        if len(found) == len(keys):
+            break
+    return found
+
+
+def latest_params(session_id: str, keys: Tuple[str, ...] = ()) -> Dict[str, Any]:
+    """Latest params snapshot ({"ts", "data"}); with `keys`, the newest non-empty value of each key."""
+    return _read(_latest_params, session_id, tuple(keys))
+
+
+def _fts_query(text: str) -> str:
+    # Each whitespace-separated term as a quoted phrase: implicit AND, no FTS5 operators
+    return " ".join('"' + t.replace('"', '""') + '"' for t in text.split())
+
+
+def _search_messages(con: sqlite3.Connection, match: str, limit: int, sessions: Optional[List[str]]) -> List[Dict[str, Any]]:
+    sql = (
+        "SELECT m.id, m.session_id, m.role, m.ts, s.title, "
+        "snippet(messages_fts, 0, '[', ']', '…', 16) AS snippet, bm25(messages_fts) AS score "
+        "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+        "LEFT JOIN sessions s ON s.id = m.session_id "
+        "WHERE messages_fts MATCH ?"
+    )
+    args: List[Any] = [match]
+    if sessions:
+        sql += f" AND m.session_id IN ({','.join('?' * len(sessions))})"
+        args += sessions
+    sql += " ORDER BY score LIMIT ?"
+    args.append(limit)
+    try:
+        return [dict(r) for r in con.execute(sql, args).fetchall()]
+    except sqlite3.OperationalError as e:
+        if "no such table" in str(e):
+            raise RuntimeError("full-text index unavailable (SQLite without FTS5?); see rebuild_search_index()") from e
+        raise
+
+
+def search_messages(query: str, limit: int = 20, session_filter: Any = None, raw: bool = False) -> List[Dict[str, Any]]:
+    """Ranked full-text hits across sessions: id, session_id, role, ts, title, snippet, score.
+
+    Terms must all match. Pass raw=True to use FTS5 query syntax (OR, NEAR, prefix*).
+    `session_filter` is a session id or a list of them.
+    """
+    match = query if raw else _fts_query(query)
+    if not match:
+        return []
+    sessions = [session_filter] if isinstance(session_filter, str) else list(session_filter or [])
+    return _read(_search_messages, match, limit, sessions)
+
+
+def _rebuild_search_index(con: sqlite3.Connection) -> None:
+    if not _create_fts(con):
+        raise RuntimeError("this SQLite build has no FTS5")
+    con.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+    con.execute("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')")
+
+
+def rebuild_search_index() -> None:
+    """Recreate the full-text index from messages (e.g. after restoring an old DB copy)."""
+    _write(_rebuild_search_index).result()
+
+
+def compact_params(batch: int = 500, vacuum: bool = True) -> int:
+    """Move params snapshots written before blob storage into the blobs table; returns rows moved.
+
+    Each page is its own short write, so the UI and other writers are held up only
+    briefly. With `vacuum`, the DB file is then rebuilt to give the freed pages back.
+    """
+    store = get_session_store()
+    last, total = 0, 0
+    while True:
+        last, moved = store.submit(_compact_params_page, last, max(1, int(batch))).result()
+        total += moved
+        if not last:
+            break
+    if vacuum:
+        store.flush()
+        # VACUUM cannot run inside the writer's transactions; use a connection of its own
+        con = _open(store.path)
+        try:
+            con.execute("VACUUM")
+            con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            con.close()
+    return total
+
+
+def _get_token_counts(con: sqlite3.Connection, model: str, hashes: List[str]) -> Dict[str, int]:
+    out: Dict[str, int] = {}
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        cur = con.execute(
+            f"SELECT hash, n FROM token_counts WHERE model=? AND hash IN ({','.join('?' * len(chunk))})",
+            (model, *chunk),
         )
-        cur.execute("UPDATE sessions SET updated_at=? WHERE id=?", (now, session_id))
-        con.commit()
+        out.update({r["hash"]: r["n"] for r in cur.fetchall()})
+    return out
+
+
+def get_token_counts(model: str, hashes: List[str]) -> Dict[str, int]:
+    """Cached token counts for content hashes under one tokenizer/model key."""
+    if not hashes:
+        return {}
+    return _read(_get_token_counts, model, hashes)
+
+
+def _put_token_counts(con: sqlite3.Connection, rows: List[Tuple[str, str, int]]) -> None:
+    con.executemany("INSERT OR REPLACE INTO token_counts(model, hash, n) VALUES(?,?,?)", rows)
+
+
+def put_token_counts(model: str, counts: Dict[str, int]) -> Optional[Future]:
+    if not counts:
+        return None
+    return _write(_put_token_counts, [(model, h, int(n)) for h, n in counts.items()])
+
+
+def _list_sessions(con: sqlite3.Connection, limit: int) -> List[Dict[str, Any]]:
+    cur = con.execute(
+        "SELECT id, created_at, updated_at, title FROM sessions ORDER BY updated_at DESC LIMIT ?",
+        (limit,),
+    )
+    return [dict(r) for r in cur.fetchall()]
 
 
 def list_sessions(limit: int = 50) -> List[Dict[str, Any]]:
-    ensure_db()
-    with _conn() as con:
-        cur = con.cursor()
-        cur.execute(
-            "SELECT id, created_at, updated_at, title FROM sessions ORDER BY updated_at DESC LIMIT ?",
-            (limit,),
-        )
-        return [dict(r) for r in cur.fetchall()]
+    return _read(_list_sessions, limit)
+
+
+def _session_row(con: sqlite3.Connection, session_id: str) -> Dict[str, Any]:
+    row = con.execute("SELECT id, created_at, updated_at, title FROM sessions WHERE id=?", (session_id,)).fetchone()
+    return dict(row) if row else {}
+
+
+def _get_session(con: sqlite3.Connection, session_id: str) -> Dict[str, Any]:
+    out = _session_row(con, session_id)
+    if not out:
+        return {}
+    cur = con.cursor()
+    cur.execute(
+        "SELECT role, content, ts, meta FROM messages WHERE session_id=? ORDER BY id ASC",
+        (session_id,),
+    )
+    messages = [
+        {
+            "role": r["role"],
+            "content": r["content"],
+            "ts": r["ts"],
+            "meta": json.loads(r["meta"] or "{}"),
+        }
+        for r in cur.fetchall()
+    ]
+    cur.execute(
+        "SELECT ts, data, blob FROM params WHERE session_id=? ORDER BY id ASC",
+        (session_id,),
+    )
+    blobs = _BlobReader(con)
+    params = [{"ts": r["ts"], "data": blobs.params(r)} for r in cur.fetchall()]
+    out["messages"] = messages
+    out["params_history"] = params
+    return out
 
 
 def get_session(session_id: str) -> Dict[str, Any]:
-    ensure_db()
-    with _conn() as con:
-        cur = con.cursor()
-        cur.execute("SELECT id, created_at, updated_at, title FROM sessions WHERE id=?", (session_id,))
-        row = cur.fetchone()
-        if not row:
-            return {}
-        cur.execute(
-            "SELECT role, content, ts, meta FROM messages WHERE session_id=? ORDER BY id ASC",
-            (session_id,),
-        )
-        messages = [
-            {
-                "role": r["role"],
-                "content": r["content"],
-                "ts": r["ts"],
-                "meta": json.loads(r["meta"] or "{}"),
-            }
-            for r in cur.fetchall()
-        ]
-        cur.execute(
-            "SELECT ts, data FROM params WHERE session_id=? ORDER BY id ASC",
-            (session_id,),
-        )
-        params = [{"ts": r["ts"], "data": json.loads(r["data"] or "{}")} for r in cur.fetchall()]
-        out = dict(row)
-        out["messages"] = messages
-        out["params_history"] = params
-        return out
+    return _read(_get_session, session_id)
 
 
 def export_session(session_id: str) -> Dict[str, Any]:
     return get_session(session_id)
 
 
-def export_markdown(session_id: str) -> str:
-    data = get_session(session_id)
-    if not data:
-        return ""
-    from datetime import datetime
-    title = data.get("title") or session_id
+def _markdown_header(title: str, latest: Dict[str, Any]) -> List[str]:
     lines = [f"# Session: {title}", ""]
     # include a brief params summary (last UI/gen snapshot)
-    params = data.get("params_history", [])
-    last_ui = None
-    last_gen = None
-    for p in reversed(params):
-        d = p.get("data", {})
-        if d.get("ui") and last_ui is None:
-            last_ui = d.get("ui")
-        if d.get("gen") and last_gen is None:
-            last_gen = d.get("gen")
-        if last_ui and last_gen:
-            break
+    last_ui = latest.get("ui")
+    last_gen = latest.get("gen")
     if last_ui or last_gen:
         lines.append("## Params")
         if last_ui:
@@ -179,13 +772,149 @@ def export_markdown(session_id: str) -> str:
             if last_gen.get("stop"):
                 lines.append(f"- stop: {last_gen.get('stop')}")
         lines.append("")
-    for m in data.get("messages", []):
-        ts = m.get("ts")
-        dt = datetime.fromtimestamp(ts).isoformat(sep=" ") if ts else ""
-        role = m.get("role", "")
-        content = m.get("content", "")
-        lines.append(f"## {role.title()}  {dt}")
-        lines.append("")
-        lines.append(content)
-        lines.append("")
+    return lines
+
+
+def _markdown_message(m: Any) -> List[str]:
+    ts = m["ts"]
+    dt = datetime.fromtimestamp(ts).isoformat(sep=" ") if ts else ""
+    role = m["role"] or ""
+    return [f"## {role.title()}  {dt}", "", m["content"] or "", ""]
+
+
+def export_markdown(session_id: str) -> str:
+    data = _read(_session_row, session_id)
+    if not data:
+        return ""
+    title = data.get("title") or session_id
+    lines = _markdown_header(title, latest_params(session_id, ("ui", "gen")))
+    for m in iter_messages(session_id):
+        lines += _markdown_message(m)
     return "\n".join(lines)
+
+
+def _export_rows(con: sqlite3.Connection, session_id: Optional[str], since: Optional[float], until: Optional[float],
+                 after_id: int, batch: int) -> Iterator[sqlite3.Row]:
+    sql = ("SELECT m.id, m.session_id, m.role, m.content, m.ts, m.meta, s.title "
+           "FROM messages m LEFT JOIN sessions s ON s.id = m.session_id WHERE m.id > ?")
+    args: List[Any] = [after_id]
+    if session_id is not None:
+        sql += " AND m.session_id = ?"
+        args.append(session_id)
+    if since is not None:
+        sql += " AND m.ts >= ?"
+        args.append(since)
+    if until is not None:
+        sql += " AND m.ts < ?"
+        args.append(until)
+    cur = con.execute(sql + " ORDER BY m.id ASC", args)
+    while True:
+        rows = cur.fetchmany(batch)
+        if not rows:
+            return
+        yield from rows
+
+
+def _export_chunks(fmt: str, session_id: Optional[str], since: Optional[float], until: Optional[float],
+                   after_id: int, batch: int) -> Iterator[Tuple[int, str]]:
+    """(message id, text) pairs in id order, read through a private connection with a streaming cursor."""
+    if fmt not in ("markdown", "jsonl"):
+        raise ValueError(f"unknown export format: {fmt!r}")
+    store = get_session_store()
+    store.flush()
+    # Own connection: one long read must not hold the shared reader lock
+    con = _open(store.path)
+    try:
+        current: Optional[str] = None
+        if after_id and fmt == "markdown":
+            # Resuming: the output already ends inside the session of message `after_id`
+            prev = con.execute("SELECT session_id FROM messages WHERE id=?", (after_id,)).fetchone()
+            current = prev["session_id"] if prev else None
+        for r in _export_rows(con, session_id, since, until, after_id, batch):
+            if fmt == "jsonl":
+                yield r["id"], json.dumps({
+                    "id": r["id"], "session_id": r["session_id"], "title": r["title"], "role": r["role"],
+                    "content": r["content"], "ts": r["ts"], "meta": json.loads(r["meta"] or "{}"),
+                }, ensure_ascii=False) + "\n"
+                continue
+            lines: List[str] = []
+            if r["session_id"] != current:
+                # Chronological order: a session's heading repeats when turns from other sessions interleave
+                current = r["session_id"]
+                latest = _latest_params(con, current, ("ui", "gen")) if session_id is not None else {}
+                lines = _markdown_header(r["title"] or current, latest)
+            lines += _markdown_message(r)
+            yield r["id"], "\n".join(lines) + "\n"
+    finally:
+        con.close()
+
+
+def iter_export(fmt: str = "jsonl", session_id: Optional[str] = None, since: Optional[float] = None,
+                until: Optional[float] = None, after_id: int = 0, batch: int = 500) -> Iterator[str]:
+    """Stream an export as text pieces ("jsonl": one JSON object per message, or "markdown").
+
+    Covers one session, messages with since <= ts < until, or the whole DB. Rows
+    come in message-id order through a cursor read `batch` rows at a time, so
+    memory stays flat however large the export.
+    """
+    for _, text in _export_chunks(fmt, session_id, since, until, after_id, batch):
+        yield text
+
+
+def export_to(dest: Any, fmt: str = "jsonl", session_id: Optional[str] = None, since: Optional[float] = None,
+              until: Optional[float] = None, after_id: int = 0, batch: int = 500) -> int:
+    """Write an export to a path or a text stream; returns the last message id written.
+
+    Pass that id back as `after_id` to resume an interrupted export. A path is
+    appended to when resuming, truncated otherwise.
+    """
+    last = after_id
+    if hasattr(dest, "write"):
+        f, close = dest, False
+    else:
+        f, close = open(dest, "a" if after_id else "w", encoding="utf-8"), True
+    try:
+        for i, (mid, text) in enumerate(_export_chunks(fmt, session_id, since, until, after_id, batch), 1):
+            f.write(text)
+            last = mid
+            if i % batch == 0:
+                f.flush()
+        f.flush()
+    finally:
+        if close:
+            f.close()
+    return last
+
+
+# --- asyncio wrappers: writes await their commit without a thread hop, reads run in a worker thread ---
+async def flush_async() -> None:
+    await asyncio.to_thread(flush)
+
+
+async def upsert_session_async(session_id: str, title: str = "") -> None:
+    await asyncio.wrap_future(upsert_session(session_id, title))
+
+
+async def add_message_async(session_id: str, role: str, content: str, meta: Optional[Dict[str, Any]] = None) -> int:
+    return await asyncio.wrap_future(add_message(session_id, role, content, meta))
+
+
+async def add_params_async(session_id: str, data: Dict[str, Any]) -> None:
+    await asyncio.wrap_future(add_params(session_id, data))
+
+
+async def list_sessions_async(limit: int = 50) -> List[Dict[str, Any]]:
+    return await asyncio.to_thread(list_sessions, limit)
+
+
+async def get_session_async(session_id: str) -> Dict[str, Any]:
+    return await asyncio.to_thread(get_session, session_id)
+
+
+async def export_to_async(dest: Any, fmt: str = "jsonl", session_id: Optional[str] = None, since: Optional[float] = None,
+                          until: Optional[float] = None, after_id: int = 0) -> int:
+    return await asyncio.to_thread(export_to, dest, fmt, session_id, since, until, after_id)
+
+
+async def search_messages_async(query: str, limit: int = 20, session_filter: Any = None, raw: bool = False) -> List[Dict[str, Any]]:
+    return await asyncio.to_thread(search_messages, query, limit, session_filter, raw)
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+
+@dataclass
+class CoalesceConfig:
+    max_delay: float = 0.033      # flush at least every ~2 frames at 60 Hz
+    max_chars: int = 256          # ...or as soon as this much text is pending
+    max_buffer: int = 8192        # pending chars before the producer stops pulling upstream
+
+    @classmethod
+    def from_meta(cls, meta: Optional[Dict[str, Any]]) -> Optional["CoalesceConfig"]:
+        cfg = (meta or {}).get("stream")
+        if not isinstance(cfg, dict) or not (cfg.get("coalesce_ms") or cfg.get("coalesce_chars")):
+            return None
+        return cls(
+            max_delay=float(cfg.get("coalesce_ms") or cls.max_delay * 1000.0) / 1000.0,
+            max_chars=int(cfg.get("coalesce_chars") or cls.max_chars),
+            max_buffer=int(cfg.get("max_buffer") or cls.max_buffer),
+        )
+
+
+async def coalesce(source: AsyncIterator[str], cfg: Optional[CoalesceConfig] = None) -> AsyncIterator[str]:
+    """Re-chunk a token stream by time window and size.
+
+    A producer task drains `source` into a bounded buffer. When the buffer is full
+    it stops reading, so a slow consumer pushes back on the upstream connection.
+    The consumer waits at most `max_delay` after the first pending token. That is
+    one timer per flush, not one per token.
+    """
+    cfg = cfg or CoalesceConfig()
+    buf: List[str] = []
+    size = 0
+    done = False
+    error: Optional[BaseException] = None
+    ready = asyncio.Event()      # something to flush (or finished)
+    full = asyncio.Event()       # flush now: max_chars reached (or finished)
+    drained = asyncio.Event()    # consumer took the buffer
+
+    async def _produce() -> None:
+        nonlocal size, done, error
+        try:
+            async for tok in source:
+                while size >= cfg.max_buffer:
+                    drained.clear()
+                    await drained.wait()
+                buf.append(tok)
+                size += len(tok)
+                ready.set()
+                if size >= cfg.max_chars:
+                    full.set()
+        except Exception as e:
+            error = e
+        finally:
+            done = True
+            ready.set()
+            full.set()
+
+    producer = asyncio.ensure_future(_produce())
+    try:
+        while True:
+            if not done:
+                await ready.wait()
+                if not full.is_set():
+                    try:
+                        await asyncio.wait_for(full.wait(), cfg.max_delay)
+                    except asyncio.TimeoutError:
+                        pass
+            ready.clear()
+            full.clear()
+            if buf:
+                text = "".join(buf)
+                buf.clear()
+                size = 0
+                drained.set()
+                yield text
+            elif done:
+                if error is not None:
+                    raise error
+                return
+    finally:
+        producer.cancel()
+
+
+class StreamFanout:
+    """Deliver one stream to several consumers (UI, logger, agent hooks).
+
+    Each subscriber has a bounded queue. The pump waits on the slowest one, so
+    backpressure reaches upstream instead of memory growing. The assembled text
+    is kept once in `text` so consumers need not rebuild it.
+    """
+
+    _END = object()
+
+    def __init__(self, source: AsyncIterator[str], max_pending: int = 64):
+        self._source = source
+        self._max_pending = max(1, int(max_pending))
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._parts: List[str] = []
+        self.error: Optional[BaseException] = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    def subscribe(self, name: str) -> AsyncIterator[str]:
+        """Register a consumer before run(); iterate the result to receive chunks."""
+        q: asyncio.Queue = asyncio.Queue(maxsize=self._max_pending)
+        self._queues[name] = q
+
+        async def _iter() -> AsyncIterator[str]:
+            try:
+                while True:
+                    item = await q.get()
+                    if item is StreamFanout._END:
+                        return
+                    yield item
+            finally:
+                # A consumer that stops early must not stall the others
+                self._queues.pop(name, None)
+                while not q.empty():
+                    q.get_nowait()
+        return _iter()
+
+    def unsubscribe(self, name: str) -> None:
+        q = self._queues.pop(name, None)
+        if q is not None:
+            # A full queue still has to end: drop the oldest chunk to make room for the sentinel
+            if q.full():
+                q.get_nowait()
+            q.put_nowait(StreamFanout._END)
+
+    async def run(self) -> str:
+        """Pump the source to all subscribers; returns the full text."""
+        try:
+            async for chunk in self._source:
+                self._parts.append(chunk)
+                for q in list(self._queues.values()):
+                    await q.put(chunk)
+        except BaseException as e:
+            if isinstance(e, Exception):
+                self.error = e
+            for q in list(self._queues.values()):
+                # Aborting: make room for the sentinel rather than block on a stalled consumer
+                while q.full():
+                    q.get_nowait()
+                q.put_nowait(StreamFanout._END)
+            raise
+        for q in list(self._queues.values()):
+            await q.put(StreamFanout._END)
+        return self.text
@@ -1,12 +1,22 @@
 from __future__ import annotations
 
 import asyncio
+import os
+import re
+import socket
 import subprocess
-from dataclasses import dataclass
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import Optional, AsyncIterator
+from typing import TYPE_CHECKING, Any, Deque, Dict, List, Optional, AsyncIterator, Tuple
 
-import httpx
+from .chat import once_chat
+from .http_pool import get_client
+
+if TYPE_CHECKING:
+    from .router import LoadAwareRouter
 
 
 @dataclass
@@ -21,13 +31,181 @@ class RunnerConfig:
     batch_size: int = 512
     rope_freq_base: float | None = None
     rope_freq_scale: float | None = None
+    parallel: int = 1                  # llama-server slots (-np)
+    cpus: list[int] | None = None      # CPU affinity for the process (Linux only)
+
+
+# llama-server timing/slot log lines, e.g.
+#   prompt eval time =   40.11 ms /    13 tokens (    3.09 ms per token,   324.11 tokens per second)
+#          eval time =  901.23 ms /    64 runs   (   14.08 ms per token,    71.01 tokens per second)
+#   slot update_slots: id  0 | task 3 | new prompt, n_ctx_slot = 4096, n_keep = 0, n_prompt_tokens = 13
+#   slot      release: id  0 | task 3 | stop processing: n_past = 77, truncated = 0
+_TIMING_RE = re.compile(r"(prompt eval|eval) time\s*=\s*([\d.]+)\s*ms\s*/\s*(\d+)\s*(?:tokens|runs)"
+                        r"\s*\(\s*[\d.]+\s*ms per token,\s*([\d.]+)\s*tokens per second\)")
+_SLOT_RE = re.compile(r"\bslot\s+(\w+):\s*id\s+(\d+)\s*\|")
+_N_CTX_SLOT_RE = re.compile(r"n_ctx_slot\s*=\s*(\d+)")
+_N_PAST_RE = re.compile(r"n_past\s*=\s*(\d+)")
+
+
+def _free_port(host: str) -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def _terminate(proc: subprocess.Popen, timeout: float) -> None:
+    if proc.poll() is None:
+        try:
+            proc.terminate()
+            proc.wait(timeout=timeout)
+        except Exception:
+            try:
+                proc.kill()
+            except Exception:
+                pass
+
+
+class LogMetrics:
+    """Throughput and slot usage parsed from llama-server log lines."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.prompt_tps: Optional[float] = None   # last request
+        self.eval_tps: Optional[float] = None
+        self.prompt_tokens = 0                    # totals since start
+        self.prompt_ms = 0.0
+        self.eval_tokens = 0
+        self.eval_ms = 0.0
+        self.requests = 0
+        self.slots: Dict[int, Dict[str, Any]] = {}
+
+    def feed(self, line: str) -> None:
+        m = _TIMING_RE.search(line)
+        if m:
+            kind, ms, n, tps = m.group(1), float(m.group(2)), int(m.group(3)), float(m.group(4))
+            with self._lock:
+                if kind == "prompt eval":
+                    self.prompt_tps, self.prompt_tokens, self.prompt_ms = tps, self.prompt_tokens + n, self.prompt_ms + ms
+                else:
+                    self.eval_tps, self.eval_tokens, self.eval_ms = tps, self.eval_tokens + n, self.eval_ms + ms
+                    self.requests += 1
+            return
+        m = _SLOT_RE.search(line)
+        if not m:
+            return
+        with self._lock:
+            slot = self.slots.setdefault(int(m.group(2)), {"busy": False, "n_ctx_slot": None, "n_past": None})
+            if "stop processing" in line or m.group(1) == "release":
+                slot["busy"] = False
+            elif m.group(1) in ("launch_slot_", "update_slots"):
+                slot["busy"] = True
+            c = _N_CTX_SLOT_RE.search(line)
+            if c:
+                slot["n_ctx_slot"] = int(c.group(1))
+            p = _N_PAST_RE.search(line)
+            if p:
+                slot["n_past"] = int(p.group(1))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            slots = {}
+            for i, s in sorted(self.slots.items()):
+                fill = (s["n_past"] / s["n_ctx_slot"]) if s["n_past"] is not None and s["n_ctx_slot"] else None
+                slots[i] = {**s, "kv_fill": fill}
+            return {
+                "prompt_tps": self.prompt_tps,
+                "eval_tps": self.eval_tps,
+                "avg_prompt_tps": (self.prompt_tokens * 1000.0 / self.prompt_ms) if self.prompt_ms else None,
+                "avg_eval_tps": (self.eval_tokens * 1000.0 / self.eval_ms) if self.eval_ms else None,
+                "prompt_tokens": self.prompt_tokens,
+                "eval_tokens": self.eval_tokens,
+                "requests": self.requests,
+                "slots_busy": sum(1 for s in self.slots.values() if s["busy"]),
+                "slots": slots,
+            }
+
+
+class _LogDrain:
+    """Always-on reader for a process pipe.
+
+    A daemon thread reads every line into a bounded ring buffer, so the server can
+    never block on a full stdout pipe whether or not anyone is listening. Async
+    subscribers get lines through bounded queues on their own loops. A subscriber
+    that falls behind loses lines rather than stalling the reader.
+    """
+
+    def __init__(self, stream, max_lines: int, metrics: LogMetrics, queue_size: int = 1024) -> None:
+        self.lines: Deque[str] = deque(maxlen=max_lines)
+        self.metrics = metrics
+        self.dropped = 0
+        self.closed = False
+        self._stream = stream
+        self._queue_size = queue_size
+        self._subs: List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = []
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="llama-log-drain", daemon=True)
+        self._thread.start()
+
+    def _offer(self, q: asyncio.Queue, line: Optional[str]) -> None:
+        # Runs on the subscriber's loop
+        if q.full():
+            if line is not None:
+                self.dropped += 1
+                return
+            q.get_nowait()  # always make room for end-of-stream
+        q.put_nowait(line)
+
+    def _publish(self, line: Optional[str]) -> None:
+        with self._lock:
+            subs = list(self._subs)
+        for loop, q in subs:
+            try:
+                loop.call_soon_threadsafe(self._offer, q, line)
+            except RuntimeError:  # subscriber's loop is closed
+                self.unsubscribe(q)
+
+    def _run(self) -> None:
+        try:
+            for raw in iter(self._stream.readline, ""):
+                line = raw.rstrip()
+                self.metrics.feed(line)
+                with self._lock:
+                    self.lines.append(line)
+                self._publish(line)
+        except Exception:
+            pass
+        finally:
+            with self._lock:
+                self.closed = True
+            self._publish(None)
+
+    def subscribe(self, backlog: bool = False) -> asyncio.Queue:
+        q: asyncio.Queue = asyncio.Queue(maxsize=self._queue_size)
+        with self._lock:
+            if backlog:
+                for line in list(self.lines)[-self._queue_size + 1:]:
+                    q.put_nowait(line)
+            if self.closed:
+                q.put_nowait(None)
+            else:
+                self._subs.append((asyncio.get_running_loop(), q))
+        return q
+
+    def unsubscribe(self, q: asyncio.Queue) -> None:
+        with self._lock:
+            self._subs = [(l, s) for l, s in self._subs if s is not q]
 
 
 class LlamaServerSupervisor:
-    def __init__(self, cfg: RunnerConfig, cwd: Optional[Path] = None) -> None:
+    def __init__(self, cfg: RunnerConfig, cwd: Optional[Path] = None, log_lines: int = 2000) -> None:
         self.cfg = cfg
         self.cwd = str(cwd) if cwd else None
         self.proc: Optional[subprocess.Popen] = None
+        self.log_lines = log_lines
+        self._logs: Optional[_LogDrain] = None
+        self._metrics = LogMetrics()
+        self.load_time_s: Optional[float] = None
+        self.warmup_time_s: Optional[float] = None
 
     def build_cmd(self) -> list[str]:
         c = self.cfg
@@ -45,8 +223,28 @@ class LlamaServerSupervisor:
             cmd += ["--rope-freq-base", str(c.rope_freq_base)]
         if c.rope_freq_scale is not None:
             cmd += ["--rope-freq-scale", str(c.rope_freq_scale)]
+        if c.parallel and c.parallel > 1:
+            cmd += ["-np", str(c.parallel)]
         return cmd
 
+    @property
+    def url(self) -> str:
+        return f"http://{self.cfg.server_host}:{self.cfg.server_port}"
+
+    def running(self) -> bool:
+        return bool(self.proc and self.proc.poll() is None)
+
+    def _pin(self) -> None:
+        # After Popen rather than preexec_fn, which is unsafe with threads in this process;
+        # llama-server starts its workers after loading, so they inherit the mask
+        cpus = self.cfg.cpus
+        if not cpus or not hasattr(os, "sched_setaffinity"):
+            return
+        try:
+            os.sched_setaffinity(self.proc.pid, cpus)
+        except OSError:
+            pass
+
     def start(self) -> None:
         if self.proc and self.proc.poll() is None:
             return
@@ -57,38 +255,244 @@ class LlamaServerSupervisor:
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             text=True,
+            errors="replace",
             bufsize=1,
         )
+        self._pin()
+        # Fresh counters per process; the drain runs for the life of the pipe
+        self._metrics = LogMetrics()
+        self._logs = _LogDrain(self.proc.stdout, self.log_lines, self._metrics)
 
     def stop(self, timeout: float = 5.0) -> None:
         if not self.proc:
             return
-        if self.proc.poll() is None:
-            try:
-                self.proc.terminate()
-                self.proc.wait(timeout=timeout)
-            except Exception:
-                try:
-                    self.proc.kill()
-                except Exception:
-                    pass
+        _terminate(self.proc, timeout)
         self.proc = None
 
+    async def swap(self, cfg: RunnerConfig, router: "LoadAwareRouter",
+                   warmup_messages: Optional[List[Dict[str, str]]] = None, timeout: float = 300.0,
+                   drain_timeout: float = 120.0) -> str:
+        """Replace the running server with `cfg` (new model, n_ctx, ...) without a gap in service.
+
+        The new server starts on a spare port (if `cfg` asks for the port in use)
+        and must be ready, and warmed when `warmup_messages` is given, before
+        anything switches. Callers must reach the server through `router` (pass it
+        to orchestrate_*), since that is the only thing that learns the new URL;
+        it and this supervisor switch in one step. The old process keeps serving
+        its in-flight requests until the router reports them drained or
+        `drain_timeout` passes, and is then stopped. Returns the new URL. If
+        the new server fails to come up, it is stopped and the old one is left
+        untouched.
+        """
+        if router is None:
+            raise ValueError("swap needs the router that callers use to reach this server")
+        if self.running() and cfg.server_port == self.cfg.server_port:
+            cfg = replace(cfg, server_port=_free_port(cfg.server_host))
+        nxt = type(self)(cfg, cwd=Path(self.cwd) if self.cwd else None, log_lines=self.log_lines)
+        try:
+            await nxt.start_and_wait_ready(timeout=timeout, warmup_messages=warmup_messages)
+        except BaseException:
+            await asyncio.to_thread(nxt.stop)
+            raise
+        old_url, old_proc = self.url, self.proc
+        # Switch: no await between these, so no request sees a half-updated state
+        self.cfg, self.proc, self._logs, self._metrics = nxt.cfg, nxt.proc, nxt._logs, nxt._metrics
+        self.load_time_s, self.warmup_time_s = nxt.load_time_s, nxt.warmup_time_s
+        router.add(self.url)
+        router.drain(old_url)
+        if old_proc is not None and old_proc.poll() is None:
+            await router.wait_drained(old_url, timeout=drain_timeout)
+            await asyncio.to_thread(_terminate, old_proc, 5.0)
+        router.remove(old_url)
+        return self.url
+
     async def probe(self) -> bool:
         url = f"http://{self.cfg.server_host}:{self.cfg.server_port}/v1/models"
         try:
-            async with httpx.AsyncClient(timeout=3.0) as client:
-                r = await client.get(url)
-                return r.status_code == 200
+            r = await get_client(url).get(url, timeout=3.0)
+            return r.status_code == 200
         except Exception:
             return False
 
-    async def iter_logs(self) -> AsyncIterator[str]:
-        if not self.proc or not self.proc.stdout:
-            return
-        loop = asyncio.get_event_loop()
-        while self.proc and self.proc.poll() is None:
-            line = await loop.run_in_executor(None, self.proc.stdout.readline)
-            if not line:
+    async def _health_status(self) -> Optional[int]:
+        url = self.url + "/health"
+        try:
+            r = await get_client(url).get(url, timeout=3.0)
+            return r.status_code
+        except Exception:
+            return None
+
+    async def start_and_wait_ready(self, timeout: float = 300.0,
+                                   warmup_messages: Optional[List[Dict[str, str]]] = None) -> float:
+        """Start the server and wait until the model is loaded; returns the load time in seconds.
+
+        /health answers 503 while the model loads and 200 once it can serve (builds
+        without /health fall back to probe()). With `warmup_messages`, each slot then
+        evaluates them once (max_tokens=1, cache_prompt) so the first real turn
+        reuses the cached prefix. Raises TimeoutError, or RuntimeError if the
+        process exits while loading.
+        """
+        t0 = time.monotonic()
+        self.start()
+        delay = 0.05
+        while True:
+            if not self.running():
+                tail = "; ".join(self.recent_logs(3))
+                raise RuntimeError(f"llama-server exited during load: {tail}")
+            status = await self._health_status()
+            if status == 200 or (status == 404 and await self.probe()):
                 break
-            yield line.rstrip()
+            if time.monotonic() - t0 >= timeout:
+                raise TimeoutError(f"llama-server not ready after {timeout:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(1.0, delay * 1.5)
+        self.load_time_s = time.monotonic() - t0
+        if warmup_messages:
+            await self.warmup(warmup_messages)
+        return self.load_time_s
+
+    async def warmup(self, messages: List[Dict[str, str]]) -> None:
+        """Prime every slot's prompt cache with `messages`; failures are not fatal."""
+        t0 = time.monotonic()
+        n_slots = max(1, int(self.cfg.parallel or 1))
+
+        async def _one(slot: int) -> None:
+            gen: Dict[str, Any] = {"max_tokens": 1, "cache_prompt": True}
+            if n_slots > 1:
+                gen["id_slot"] = slot
+            try:
+                await once_chat(self.url, messages, gen=gen)
+            except Exception:
+                pass
+
+        await asyncio.gather(*(_one(i) for i in range(n_slots)))
+        self.warmup_time_s = time.monotonic() - t0
+
+    async def iter_logs(self, backlog: bool = False) -> AsyncIterator[str]:
+        """Follow the server log until the process exits; `backlog` first replays buffered lines."""
+        drain = self._logs
+        if drain is None:
+            return
+        q = drain.subscribe(backlog=backlog)
+        try:
+            while True:
+                line = await q.get()
+                if line is None:
+                    return
+                yield line
+        finally:
+            drain.unsubscribe(q)
+
+    def recent_logs(self, n: int = 200) -> List[str]:
+        if self._logs is None:
+            return []
+        return list(self._logs.lines)[-n:]
+
+    def metrics(self) -> Dict[str, Any]:
+        """Parsed llama-server throughput and slot/KV usage for the current process."""
+        out = self._metrics.snapshot()
+        out["log_dropped"] = self._logs.dropped if self._logs else 0
+        return out
+
+
+class LlamaServerPool:
+    """N llama-server instances from one RunnerConfig template on consecutive ports.
+
+    Threads and (on Linux) the CPUs this process may use are split evenly across
+    instances. monitor() probes every instance and restarts crashed ones with
+    exponential backoff. healthy_endpoints() is the live routing set.
+    """
+
+    def __init__(self, template: RunnerConfig, instances: int, cwd: Optional[Path] = None,
+                 check_interval: float = 2.0, max_backoff: float = 60.0, stable_after: float = 30.0) -> None:
+        self.template = template
+        self.check_interval = check_interval
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.members: List[LlamaServerSupervisor] = [
+            LlamaServerSupervisor(cfg, cwd=cwd) for cfg in self._member_configs(max(1, int(instances)))
+        ]
+        n = len(self.members)
+        self._healthy: List[bool] = [False] * n
+        self._started_at: List[float] = [0.0] * n
+        self._backoff: List[float] = [0.0] * n
+        self._next_restart: List[float] = [0.0] * n
+        self.restarts: List[int] = [0] * n
+        self._monitor: Optional[asyncio.Task] = None
+
+    def _member_configs(self, n: int) -> List[RunnerConfig]:
+        t = self.template
+        threads = max(1, t.threads // n)
+        cpus: List[int] = list(t.cpus or [])
+        if not cpus and hasattr(os, "sched_getaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+        per = len(cpus) // n if cpus else 0
+        out = []
+        for i in range(n):
+            cpu_set = cpus[i * per:(i + 1) * per] if per else None
+            out.append(replace(t, server_port=t.server_port + i, threads=threads, cpus=cpu_set))
+        return out
+
+    def _start_member(self, i: int) -> None:
+        self.members[i].start()
+        self._started_at[i] = time.monotonic()
+        self._healthy[i] = False
+
+    def start(self) -> None:
+        for i in range(len(self.members)):
+            self._start_member(i)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+        for m in self.members:
+            m.stop(timeout=timeout)
+        self._healthy = [False] * len(self.members)
+
+    async def check_once(self) -> None:
+        """Probe every instance; restart exited ones whose backoff has elapsed."""
+        now = time.monotonic()
+        results = await asyncio.gather(*(m.probe() for m in self.members))
+        for i, (m, ok) in enumerate(zip(self.members, results)):
+            self._healthy[i] = bool(ok) and m.running()
+            if self._healthy[i] and now - self._started_at[i] >= self.stable_after:
+                self._backoff[i] = 0.0
+            if m.running() or now < self._next_restart[i]:
+                continue
+            m.stop()
+            self._start_member(i)
+            self.restarts[i] += 1
+            self._backoff[i] = min(self.max_backoff, (self._backoff[i] * 2) or 1.0)
+            self._next_restart[i] = now + self._backoff[i]
+
+    async def monitor(self) -> None:
+        while True:
+            try:
+                await self.check_once()
+            except Exception:
+                pass
+            await asyncio.sleep(self.check_interval)
+
+    def start_monitor(self) -> asyncio.Task:
+        if self._monitor is None or self._monitor.done():
+            self._monitor = asyncio.ensure_future(self.monitor())
+        return self._monitor
+
+    def healthy_endpoints(self) -> List[str]:
+        return [m.url for m, ok in zip(self.members, self._healthy) if ok]
+
+    def status(self) -> List[Dict[str, object]]:
+        return [
+            {
+                "url": m.url,
+                "running": m.running(),
+                "healthy": self._healthy[i],
+                "restarts": self.restarts[i],
+                "threads": m.cfg.threads,
+                "cpus": m.cfg.cpus,
+                "load_time_s": m.load_time_s,
+                "metrics": m.metrics(),
+            }
+            for i, m in enumerate(self.members)
+        ]